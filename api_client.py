@@ -0,0 +1,121 @@
+import json
+import socket
+import http.client
+import urllib.parse
+import constants
+import parser_classes
+import database_management
+
+"""
+classes
+"""
+
+# HTTP connection over a unix socket
+class UnixHttpConnection(http.client.HTTPConnection):
+    def __init__(self, socketPath, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+# thin client for the API served by api_server, so that several user interfaces and
+# scripts can share one database and one refresh pipeline
+class ApiClient:
+    def __init__(self, socketPath=constants.API_SOCKET_PATH, timeout=None):
+        self.socketPath = socketPath
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        connection = UnixHttpConnection(self.socketPath, timeout=self.timeout)
+        try:
+            headers = {}
+            data = None
+            if body is not None:
+                data = json.dumps(body).encode()
+                headers['Content-Type'] = 'application/json'
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            content = json.loads(response.read())
+            if response.status != 200:
+                raise ApiError(content.get('error', response.reason))
+            return content
+        finally:
+            connection.close()
+
+    # check whether a server is listening on the socket
+    def isAvailable(self):
+        try:
+            self.getSubscriptions()
+            return True
+        except (OSError, ApiError, ValueError):
+            return False
+
+    def getDatabase(self):
+        return database_management.decodeDatabase(self.getDatabaseContent())
+
+    # get the json representation of the database, without decoding it
+    def getDatabaseContent(self):
+        return self.request('GET', '/database')
+
+    def getSubscriptions(self):
+        return self.request('GET', '/subscriptions')
+
+    def getFeed(self, channelId):
+        return self.request('GET', f"/feeds/{urllib.parse.quote(channelId)}")
+
+    # get statistics of the connection limiter of the server
+    def getStats(self):
+        return self.request('GET', '/stats')
+
+    def getUnseenCounts(self):
+        return self.request('GET', '/unseen')
+
+    # set the seen-state of entries, given as a dict from entry id to seen-state
+    def setSeen(self, seenById):
+        return self.request('POST', '/seen', {'seen': seenById})['changed']
+
+    def search(self, query, kind='video'):
+        return self.request('GET', '/search?' + urllib.parse.urlencode({'kind': kind,
+            'query': query}))
+
+    # search through the server, getting the same result objects as
+    # connection_management.getChannelQueryResults
+    def getChannelQueryResults(self, query):
+        return [parser_classes.ChannelQueryObject(channelId=result['channelId'],
+            title=result['title']) for result in self.search(query, kind='channel')]
+
+    # search through the server, getting the same result objects as
+    # connection_management.getVideoQueryResults
+    def getVideoQueryResults(self, query):
+        return [parser_classes.VideoQueryObject(videoId=result['videoId'],
+            thumbnail=result['thumbnail'], title=result['title'])
+            for result in self.search(query, kind='video')]
+
+    def refresh(self, channelIdList=None):
+        return self.request('POST', '/refresh', {'channelIds': channelIdList})['unreached']
+
+    def subscribe(self, channelId, channelTitle, refresh=False):
+        return self.request('POST', '/subscribe', {'channelId': channelId,
+            'title': channelTitle, 'refresh': refresh})['subscribed']
+
+    # subscribe to several channels, given as (channel id, title) pairs, at once; returns
+    # the ids of the channels that weren't subscribed to
+    def subscribeChannels(self, channels, refresh=False):
+        return self.request('POST', '/subscribe', {'channels': [{'channelId': channelId,
+            'title': channelTitle} for channelId, channelTitle in channels],
+            'refresh': refresh})['subscribed']
+
+    def unsubscribe(self, channelId):
+        return self.request('POST', '/unsubscribe', {'channelId': channelId})['unsubscribed']
+
+"""
+Exception classes
+"""
+
+# indicates that the server responded with an error
+class ApiError(Exception):
+    pass
@@ -0,0 +1,285 @@
+import os
+import json
+import copy
+import asyncio
+import threading
+import socketserver
+import urllib.parse
+import http.server
+import constants
+import connection_management
+import database_management
+
+"""
+classes
+"""
+
+# holds the one shared in-memory database of the server, and runs the one refresh
+# pipeline shared by all clients. Refresh requests arriving while a refresh is running
+# wait for it and share its result, rather than starting another refresh. Changes made
+# to the database file by other processes are merged in before every request
+class DatabaseService:
+    def __init__(self, databasePath=constants.DATABASE_PATH, useTor=False,
+            circuitManager=None):
+        self.databasePath = databasePath
+        self.useTor = useTor
+        self.circuitManager = circuitManager
+        self.lock = threading.RLock()
+        self.refreshLock = threading.Lock()
+        # number of full refreshes finished, so that waiting full refreshes can tell
+        # whether one finished meanwhile (refreshes of some channels don't count)
+        self.fullRefreshGeneration = 0
+        self.databaseCache = database_management.getDatabaseCache(databasePath)
+        self.database = self.databaseCache.load()
+
+    def getAuth(self):
+        if self.useTor and self.circuitManager is not None:
+            return self.circuitManager.getAuth()
+        return None
+
+    def save(self):
+        with self.lock:
+            self.databaseCache.save()
+
+    # merge in changes made to the database file (the database is updated in place)
+    def reload(self):
+        self.databaseCache.load()
+
+    def getDatabase(self):
+        with self.lock:
+            self.reload()
+            return copy.deepcopy(self.database)
+
+    def getSubscriptions(self):
+        with self.lock:
+            self.reload()
+            return dict(self.database['id to title'])
+
+    def getFeed(self, channelId):
+        with self.lock:
+            self.reload()
+            return copy.deepcopy(self.database['feeds'].get(channelId))
+
+    def getUnseenCounts(self):
+        with self.lock:
+            self.reload()
+            return {channelId: sum([1 for video in feed if not video['seen']])
+                    for channelId, feed in self.database['feeds'].items()}
+
+    # set the seen-state of entries, given as a dict from entry id to seen-state
+    def setSeen(self, seenById):
+        changed = 0
+        with self.lock:
+            self.reload()
+            for feed in self.database['feeds'].values():
+                for video in feed:
+                    if video['id'] in seenById and video['seen'] != seenById[video['id']]:
+                        video['seen'] = bool(seenById[video['id']])
+                        changed += 1
+            if changed:
+                self.save()
+        return changed
+
+    def subscribe(self, channelId, channelTitle, refresh=False):
+        return bool(self.subscribeChannels([(channelId, channelTitle)], refresh=refresh))
+
+    # subscribe to several channels, given as (channel id, title) pairs, with a single
+    # write of the database; returns the ids of the channels that weren't subscribed to
+    def subscribeChannels(self, channels, refresh=False):
+        addedChannelIds = []
+        with self.lock:
+            self.reload()
+            for channelId, channelTitle in channels:
+                if channelId in self.database['feeds']:
+                    continue
+                self.database['feeds'][channelId] = []
+                self.database['id to title'][channelId] = channelTitle
+                self.database['title to id'][channelTitle] = channelId
+                addedChannelIds.append(channelId)
+            if addedChannelIds:
+                self.save()
+        if refresh and addedChannelIds:
+            self.refresh(addedChannelIds)
+        return addedChannelIds
+
+    def unsubscribe(self, channelId):
+        with self.lock:
+            self.reload()
+            if channelId not in self.database['id to title']:
+                return False
+            channelTitle = self.database['id to title'].pop(channelId)
+            self.database['title to id'].pop(channelTitle)
+            self.database['feeds'].pop(channelId)
+            self.save()
+        return True
+
+    # merge feed content that was pushed rather than polled into the database, through
+    # the same path as a refresh
+    def mergeFeedContent(self, channelId, content):
+        entries = connection_management.parseFeedContent(content)
+        with self.lock:
+            self.reload()
+            if channelId not in self.database['feeds']:
+                return []
+            updatedEntries = []
+            newEntries = database_management.mergeEntriesIntoFeed(
+                    self.database['feeds'][channelId], entries, updatedEntries)
+            if newEntries or updatedEntries:
+                self.save()
+            changeLog = database_management.getChangeLog()
+            database_management.recordChanges(changeLog, channelId, newEntries,
+                    updatedEntries)
+            changeLog.flush()
+        return newEntries
+
+    def search(self, kind, query):
+        if kind == 'channel':
+            results = asyncio.run(connection_management.getChannelQueryResults(query,
+                useTor=self.useTor, auth=self.getAuth()))
+            return [{'channelId': result.channelId, 'title': result.title}
+                    for result in results or []]
+        results = asyncio.run(connection_management.getVideoQueryResults(query,
+            useTor=self.useTor, auth=self.getAuth()))
+        return [{'videoId': result.videoId, 'title': result.title, 'url': result.url,
+            'thumbnail': result.thumbnail} for result in results or []]
+
+    # refresh the given channels (or all channels), returning the channels that weren't
+    # reached before the refresh deadline
+    def refresh(self, channelIdList=None):
+        isFullRefresh = channelIdList is None
+        generation = self.fullRefreshGeneration
+        with self.refreshLock:
+            if isFullRefresh and self.fullRefreshGeneration != generation:
+                # a full refresh finished while we were waiting; share its result
+                return list(self.database.get('unreached', []))
+            # the refresh runs on a copy, so that clients can be served meanwhile
+            refreshedDatabase = self.getDatabase()
+            if isFullRefresh:
+                channelIdList = list(refreshedDatabase['id to title'])
+            channelIdList = [channelId for channelId in channelIdList
+                    if channelId in refreshedDatabase['feeds']]
+            unreached = asyncio.run(database_management.refreshSubscriptionsByChannelId(
+                channelIdList, useTor=self.useTor, auth=self.getAuth(),
+                database=refreshedDatabase))
+            with self.lock:
+                for channelId in channelIdList:
+                    if channelId in self.database['feeds']:
+                        database_management.mergeEntriesIntoFeed(
+                                self.database['feeds'][channelId],
+                                list(reversed(refreshedDatabase['feeds'][channelId])))
+                # channels outside of a partial refresh keep their unreached state
+                self.database['unreached'] = [channelId for channelId
+                        in self.database.get('unreached', [])
+                        if channelId not in channelIdList] + unreached
+                self.save()
+            if isFullRefresh:
+                self.fullRefreshGeneration += 1
+        return unreached
+
+# serves the API of a DatabaseService over HTTP with JSON bodies
+class ApiRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parameters = urllib.parse.parse_qs(url.query)
+        path = url.path.strip('/').split('/')
+        service = self.server.service
+        if path == ['database']:
+            self.sendJson(database_management.encodeDatabase(service.getDatabase()))
+        elif path == ['subscriptions']:
+            self.sendJson(service.getSubscriptions())
+        elif path[0] == 'feeds' and len(path) == 2:
+            feed = service.getFeed(path[1])
+            if feed is None:
+                self.sendJson({'error': 'not subscribed'}, status=404)
+            else:
+                self.sendJson([entry.toDict() for entry in feed])
+        elif path == ['unseen']:
+            self.sendJson(service.getUnseenCounts())
+        elif path == ['stats']:
+            self.sendJson(connection_management.connectionLimiter.getStats())
+        elif path == ['search']:
+            kind = parameters.get('kind', ['video'])[0]
+            query = parameters.get('query', [''])[0]
+            self.sendJson(service.search(kind, query))
+        else:
+            self.sendJson({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        path = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        body = self.readJson()
+        service = self.server.service
+        if path == ['seen']:
+            self.sendJson({'changed': service.setSeen(body.get('seen', {}))})
+        elif path == ['refresh']:
+            self.sendJson({'unreached': service.refresh(body.get('channelIds'))})
+        elif path == ['subscribe'] and 'channels' in body:
+            self.sendJson({'subscribed': service.subscribeChannels([(channel['channelId'],
+                channel['title']) for channel in body['channels']],
+                refresh=body.get('refresh', False))})
+        elif path == ['subscribe']:
+            self.sendJson({'subscribed': service.subscribe(body['channelId'],
+                body['title'], refresh=body.get('refresh', False))})
+        elif path == ['unsubscribe']:
+            self.sendJson({'unsubscribed': service.unsubscribe(body['channelId'])})
+        else:
+            self.sendJson({'error': 'not found'}, status=404)
+
+    def readJson(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def sendJson(self, content, status=200):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # requests over a unix socket have no client address to log
+    def address_string(self):
+        return 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+class UnixApiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, service):
+        self.service = service
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        socketserver.UnixStreamServer.__init__(self, socketPath, ApiRequestHandler)
+
+"""
+functions
+"""
+
+# use this function to run the API server until interrupted. If a WebSub callback URL is
+# given, new uploads are pushed to the server by the hub, and polling is only done as a
+# slow consistency sweep
+def runApiServer(socketPath=constants.API_SOCKET_PATH, useTor=False,
+        circuitManager=None, webSubCallbackUrl=None, webSubHubUrl=constants.WEBSUB_HUB_URL,
+        webSubListenAddress=(constants.WEBSUB_LISTEN_HOST, constants.WEBSUB_LISTEN_PORT)):
+    service = DatabaseService(useTor=useTor, circuitManager=circuitManager)
+    webSubManager = None
+    if webSubCallbackUrl is not None:
+        import websub
+        webSubManager = websub.WebSubManager(webSubCallbackUrl,
+                getChannelIds=lambda: list(service.getSubscriptions()),
+                onFeedContent=service.mergeFeedContent, sweep=service.refresh,
+                hubUrl=webSubHubUrl, listenAddress=webSubListenAddress, useTor=useTor,
+                circuitManager=circuitManager)
+        webSubManager.start()
+    with UnixApiServer(socketPath, service) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if webSubManager is not None:
+                webSubManager.stop()
+            os.remove(socketPath)
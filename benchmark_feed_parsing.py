@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+
+# This script measures refresh throughput (channels per second) of the fetch/parse
+# pipeline in database_management for a varying number of parsing processes. Fetching is
+# replaced by an in-memory fake with a fixed latency, so that the numbers reflect how
+# parsing scales with the number of cores rather than the speed of the network.
+
+import os
+import time
+import asyncio
+import argparse
+import concurrent.futures
+import constants
+import connection_management
+import database_management
+
+ENTRY_TEMPLATE = """
+ <entry>
+  <id>yt:video:{videoId}</id>
+  <yt:videoId>{videoId}</yt:videoId>
+  <yt:channelId>{channelId}</yt:channelId>
+  <title>Video number {i} from channel {channelId}</title>
+  <link rel="alternate" href="https://www.youtube.com/watch?v={videoId}"/>
+  <author><name>Channel {channelId}</name></author>
+  <published>2021-01-01T00:00:00+00:00</published>
+  <updated>2021-01-02T00:00:00+00:00</updated>
+  <media:group>
+   <media:title>Video number {i} from channel {channelId}</media:title>
+   <media:content url="https://www.youtube.com/v/{videoId}?version=3" type="application/x-shockwave-flash" width="640" height="390"/>
+   <media:thumbnail url="https://i4.ytimg.com/vi/{videoId}/hqdefault.jpg" width="480" height="360"/>
+   <media:description>{description}</media:description>
+   <media:community>
+    <media:starRating count="10" average="5.00" min="1" max="5"/>
+    <media:statistics views="1000"/>
+   </media:community>
+  </media:group>
+ </entry>"""
+
+FEED_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns:media="http://search.yahoo.com/mrss/" xmlns="http://www.w3.org/2005/Atom">
+ <title>Channel {channelId}</title>
+{entries}
+</feed>"""
+
+# use this function to generate a YouTube-like RSS feed with 15 entries
+def getFakeFeedContent(channelId):
+    entries = ''.join([ENTRY_TEMPLATE.format(videoId=f"{channelId[-6:]}{i:05d}",
+        channelId=channelId, i=i, description='lorem ipsum '*40) for i in range(15)])
+    return FEED_TEMPLATE.format(channelId=channelId, entries=entries).encode()
+
+def runBenchmark(nChannels, nProcesses, latency):
+    channelIds = [f"UC{i:022d}" for i in range(nChannels)]
+    contents = {channelId: getFakeFeedContent(channelId) for channelId in channelIds}
+
+    async def fakeGetRssContent(channelId, limiter=None, useTor=False, auth=None,
+            timeout=None):
+        async with limiter.slot():
+            await asyncio.sleep(latency)
+        return contents[channelId]
+
+    async def refresh(parseExecutor):
+        limiter = connection_management.AdaptiveLimiter()
+        pipelineSemaphore = asyncio.Semaphore(constants.MAX_CONNECTIONS +
+                constants.PARSE_QUEUE_SIZE)
+        feeds = {channelId: [] for channelId in channelIds}
+        await asyncio.gather(*[database_management.refreshSubscriptionByChannelId(
+            channelId, feeds[channelId], limiter, parseExecutor=parseExecutor,
+            pipelineSemaphore=pipelineSemaphore) for channelId in channelIds])
+
+    connection_management.getRssContentFromChannelId = fakeGetRssContent
+    if nProcesses == 0:
+        startTime = time.perf_counter()
+        asyncio.run(refresh(None))
+        return time.perf_counter() - startTime
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nProcesses) as executor:
+        # make sure all worker processes are started before measuring
+        list(executor.map(abs, range(nProcesses*4)))
+        startTime = time.perf_counter()
+        asyncio.run(refresh(executor))
+        return time.perf_counter() - startTime
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark refresh throughput for a " + \
+            "varying number of feed parsing processes.")
+    parser.add_argument('--channels', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.05,
+            help="simulated fetch latency in seconds")
+    parser.add_argument('--max-processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    processCounts = [0] + [n for n in [1, 2, 4, 8, 16, 32, 64]
+            if n < args.max_processes] + [args.max_processes]
+    print(f"{'processes':>10} {'seconds':>10} {'channels/s':>12}")
+    for nProcesses in processCounts:
+        elapsed = runBenchmark(args.channels, nProcesses, args.latency)
+        label = 'inline' if nProcesses == 0 else str(nProcesses)
+        print(f"{label:>10} {elapsed:>10.2f} {args.channels/elapsed:>12.1f}")
@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+
+# This script measures how expensive the user interface is, by replaying scripted
+# keypress sequences in doSelectionQuery on a headless virtual screen, for menus of
+# varying length and terminals of varying size. For every combination, the time to open
+# the menu (until it waits for the first key), the latency per keystroke (handling the
+# key and rendering the result) and the number of cells written per keystroke are
+# reported.
+
+import argparse
+import statistics
+import presentation
+import method_menu
+import indicator_classes
+
+# use this function to get a menu shaped like the video menu of a channel
+def getFakeMenu(nItems):
+    videos = [{'title': f"Video number {i} with a reasonably long title", 'seen': i%3 == 0}
+            for i in range(nItems)]
+    return method_menu.LazyMenuOptions(videos,
+            lambda video : method_menu.MethodMenuDecision(
+                method_menu.FeedVideoDescriber(video), print),
+            header=[method_menu.MethodMenuDecision("[Go back]", print)])
+
+# use this function to get the scripted keypress sequences that are replayed
+def getKeyScripts(nItems):
+    jumpTarget = str(max(nItems//2, 1))
+    return {
+        'scroll': [ord('j')]*100 + [ord('k')]*100,
+        'jump': [ord('G'), ord('g')]*50,
+        'number': ([ord(digit) for digit in jumpTarget] + [10] + [ord('g')])*20
+    }
+
+def runBenchmark(nItems, height, width, keys):
+    screen = presentation.VirtualScreen(height, width, keys)
+    presentation.useRenderBackend(presentation.VirtualBackend(screen))
+    try:
+        presentation.doSelectionQuery("Which video do you want to watch?",
+                getFakeMenu(nItems), queryStyle=indicator_classes.IndexQuery)
+    except presentation.OutOfKeys:
+        pass
+    return screen.opens[0][0], screen.keystrokes
+
+def getTerminalSize(string):
+    height, width = string.lower().split('x')
+    return int(height), int(width)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark per-keystroke latency of " + \
+            "menus on a headless virtual screen.")
+    parser.add_argument('--items', type=int, nargs='+',
+            default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--sizes', type=getTerminalSize, nargs='+',
+            default=[(24, 80), (50, 200), (100, 400)], metavar='HEIGHTxWIDTH')
+    args = parser.parse_args()
+
+    print(f"{'items':>8} {'size':>8} {'script':>8} {'open us':>10} {'mean us':>10} " + \
+            f"{'p95 us':>10} {'max us':>10} {'cells/key':>10}")
+    for nItems in args.items:
+        for height, width in args.sizes:
+            for scriptName, keys in getKeyScripts(nItems).items():
+                openLatency, keystrokes = runBenchmark(nItems, height, width, keys)
+                latencies = sorted([latency*1e6 for latency, _ in keystrokes])
+                cells = statistics.mean([cellsWritten for _, cellsWritten in keystrokes])
+                p95 = latencies[int(0.95*(len(latencies)-1))]
+                print(f"{nItems:>8} {f'{height}x{width}':>8} {scriptName:>8} " + \
+                        f"{openLatency*1e6:>10.1f} " + \
+                        f"{statistics.mean(latencies):>10.1f} {p95:>10.1f} " + \
+                        f"{latencies[-1]:>10.1f} {cells:>10.1f}")
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import argparse
+import constants
+import database_management
+import api_client
+
+# Non-interactive subcommands, meant for scripts and status bars. They never touch
+# curses, only import the networking libraries when they need the network, and write
+# one JSON object per line (or tab separated values) to stdout
+
+COMMANDS = ['list-unseen', 'mark-seen', 'subscribe', 'refresh', 'export', 'profiles',
+        'changes', 'sync', 'migrate']
+
+"""
+functions
+"""
+
+# use this function to get an API client if a server is running, so that commands don't
+# read (and race with) the database file the server owns
+def getApiClient():
+    client = api_client.ApiClient(timeout=constants.TOTAL_TIMEOUT)
+    if client.isAvailable():
+        database_management.useApiClient(client)
+        return client
+    return None
+
+def getCircuitManager(useTor):
+    if not useTor:
+        return None
+    import connection_management
+    return connection_management.CircuitManager()
+
+def writeRecord(record, outputFormat):
+    if outputFormat == 'tsv':
+        sys.stdout.write('\t'.join([str(value) for value in record.values()]) + '\n')
+    else:
+        sys.stdout.write(json.dumps(record) + '\n')
+
+# use this function to find the entries in a database that an entry reference (an entry
+# id, video id or video link) points to
+def getMatchingEntries(database, references, channelIdList=None):
+    references = set(references)
+    matches = []
+    for channelId, feed in database['feeds'].items():
+        if channelIdList and channelId not in channelIdList:
+            continue
+        for video in feed:
+            videoId = video['id'].split(':')[-1]
+            if (channelIdList and not references) or video['id'] in references or \
+                    videoId in references or video['link'] in references:
+                matches.append(video)
+    return matches
+
+# use this function to list unseen entries. The database is read without decoding it,
+# and only the unseen entries are decoded
+def doListUnseen(args):
+    client = getApiClient()
+    if args.count and client is not None:
+        counts = client.getUnseenCounts()
+        print(sum([counts[channelId] for channelId in counts
+            if not args.channel or channelId in args.channel]))
+        return 0
+    if client is not None:
+        content = client.getDatabaseContent()
+    else:
+        content = database_management.readDatabaseContent(constants.DATABASE_PATH)
+    count = 0
+    for channelId, video in database_management.getUnseenEntries(content, args.channel):
+        count += 1
+        if not args.count:
+            writeRecord({'channelId': channelId,
+                'channelTitle': content['id to title'][channelId],
+                'id': video['id'], 'title': video['title'], 'link': video['link']},
+                args.format)
+    if args.count:
+        print(count)
+    return 0
+
+def doMarkSeen(args):
+    if not args.entries and not args.channel:
+        print("no entries or channels given", file=sys.stderr)
+        return 2
+    getApiClient()
+    database = database_management.loadDatabase()
+    seen = not args.unseen
+    changed = {video['id']: seen for video in getMatchingEntries(database, args.entries,
+        args.channel) if video['seen'] != seen}
+    if database_management.apiClient is not None:
+        if changed:
+            database_management.apiClient.setSeen(changed)
+    elif changed:
+        for feed in database['feeds'].values():
+            for video in feed:
+                if video['id'] in changed:
+                    video['seen'] = seen
+        database_management.saveDatabase(database)
+    for entryId in changed:
+        writeRecord({'id': entryId, 'seen': seen}, args.format)
+    return 0
+
+def doSubscribe(args):
+    import asyncio
+    import connection_management
+    getApiClient()
+    circuitManager = getCircuitManager(args.use_tor)
+    resolved, unresolved = asyncio.run(connection_management.resolveChannelReferences(
+        [(reference, args.title) for reference in args.channels], useTor=args.use_tor,
+        circuitManager=circuitManager))
+    addedChannelIds = database_management.addSubscriptionsToDatabase(resolved,
+            refresh=not args.no_refresh, useTor=args.use_tor,
+            circuitManager=circuitManager)
+    for channel in resolved:
+        writeRecord({'channelId': channel.channelId, 'title': channel.title,
+            'added': channel.channelId in addedChannelIds}, args.format)
+    for reference in unresolved:
+        print(f"could not resolve: {reference}", file=sys.stderr)
+    return 1 if unresolved else 0
+
+def doRefresh(args):
+    import asyncio
+    client = getApiClient()
+    channelIdList = args.channel if args.channel else None
+    subscriptions = client.getSubscriptions() if client is not None \
+            else database_management.loadDatabase()['id to title']
+    unsubscribed = [channelId for channelId in channelIdList or []
+            if channelId not in subscriptions]
+    if unsubscribed:
+        print(f"not subscribed to: {', '.join(unsubscribed)}", file=sys.stderr)
+        return 2
+    if client is not None:
+        unreached = client.refresh(channelIdList)
+    else:
+        circuitManager = getCircuitManager(args.use_tor)
+        auth = circuitManager.getAuth() if circuitManager is not None else None
+        if channelIdList is None:
+            channelIdList = list(subscriptions)
+        unreached = asyncio.run(database_management.refreshSubscriptionsByChannelId(
+            channelIdList, useTor=args.use_tor, auth=auth))
+    for channelId in unreached:
+        writeRecord({'unreached': channelId}, args.format)
+    if args.stats:
+        if client is not None:
+            stats = client.getStats()
+        else:
+            import connection_management
+            stats = connection_management.connectionLimiter.getStats()
+        writeRecord({'stats': stats} if args.format == 'json' else stats, args.format)
+    return 0
+
+def doExport(args):
+    import import_export
+    getApiClient()
+    database = database_management.loadDatabase()
+    outputFormat = args.format
+    if outputFormat is None:
+        outputFormat = 'csv' if args.file and args.file.lower().endswith('.csv') \
+                else 'opml'
+    content = import_export.getCsvString(database) if outputFormat == 'csv' \
+            else import_export.getOpmlString(database)
+    if args.file:
+        with open(args.file, 'w') as filePointer:
+            filePointer.write(content)
+    else:
+        sys.stdout.write(content)
+    return 0
+
+# use this function to list the entries added or updated after a change log sequence
+# number; the last record holds the sequence number to pass next time. If the changes
+# have been compacted away, the only record is {"seq": N} with the sequence number to
+# continue from after reading the whole database
+def doChanges(args):
+    try:
+        changes = database_management.since(args.since)
+    except database_management.ChangeLogTruncated as e:
+        print(f"{e}; read the whole database instead", file=sys.stderr)
+        writeRecord({'seq': e.lastSequenceNumber}, args.format)
+        return 3
+    for change in changes:
+        entry = change['entry']
+        writeRecord({'seq': change['seq'], 'change': change['change'],
+            'channelId': change['channelId'], 'id': entry['id'], 'title': entry['title'],
+            'link': entry['link']}, args.format)
+    return 0
+
+# use this function to sync subscriptions, entries and seen-state with other machines
+def doSync(args):
+    import sync
+    if args.serve:
+        sync.runSyncServer(args.serve)
+        return 0
+    try:
+        if args.dir:
+            sent, received = sync.syncWithDirectory(args.dir)
+        else:
+            sent, received = sync.syncWithPeer(args.connect)
+    except (OSError, sync.SyncFailed) as e:
+        print(f"sync failed: {e}", file=sys.stderr)
+        return 1
+    writeRecord({'sent': sent, 'received': received}, args.format)
+    return 0
+
+# use this function to rewrite the database file in the current format, optionally
+# changing whether it is gzip compressed
+def doMigrate(args):
+    database_management.migrateDatabaseFile(constants.DATABASE_PATH,
+            compress=args.compress)
+    return 0
+
+# use this function to rank the flows profiled with --profile
+def doProfiles(args):
+    import profiling
+    orderBy = 'peak memory' if args.by == 'memory' else 'wall time'
+    if not os.path.isdir(args.dir):
+        print(f"no profiles found in {args.dir}", file=sys.stderr)
+        return 1
+    for flow in profiling.getProfileSummary(args.dir, orderBy=orderBy)[:args.top]:
+        writeRecord(flow, args.format)
+    return 0
+
+def getArgumentParser():
+    parser = argparse.ArgumentParser(prog='youtube_rss.py',
+            description="Non-interactive YouTube_RSS commands.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    listUnseen = subparsers.add_parser('list-unseen', help="list unseen entries")
+    listUnseen.add_argument('--channel', action='append', metavar='CHANNEL_ID',
+            help="only list entries from this channel (may be repeated)")
+    listUnseen.add_argument('--count', action='store_true',
+            help="only print the number of unseen entries")
+    listUnseen.set_defaults(function=doListUnseen)
+
+    markSeen = subparsers.add_parser('mark-seen', help="mark entries as seen")
+    markSeen.add_argument('entries', nargs='*', metavar='ENTRY',
+            help="entry id, video id or video link")
+    markSeen.add_argument('--channel', action='append', metavar='CHANNEL_ID',
+            help="mark all entries of this channel (may be repeated)")
+    markSeen.add_argument('--unseen', action='store_true',
+            help="mark the entries as unseen instead")
+    markSeen.set_defaults(function=doMarkSeen)
+
+    subscribe = subparsers.add_parser('subscribe', help="subscribe to channels")
+    subscribe.add_argument('channels', nargs='+', metavar='CHANNEL',
+            help="channel id, RSS address, channel URL or handle")
+    subscribe.add_argument('--title', help="title to use for the channel")
+    subscribe.add_argument('--no-refresh', action='store_true')
+    subscribe.add_argument('--use-tor', action='store_true')
+    subscribe.set_defaults(function=doSubscribe)
+
+    refresh = subparsers.add_parser('refresh', help="refresh subscriptions")
+    refresh.add_argument('--channel', action='append', metavar='CHANNEL_ID',
+            help="only refresh this channel (may be repeated)")
+    refresh.add_argument('--use-tor', action='store_true')
+    refresh.add_argument('--stats', action='store_true',
+            help="print connection statistics, such as the current concurrency limit")
+    refresh.set_defaults(function=doRefresh)
+
+    export = subparsers.add_parser('export', help="export subscriptions")
+    export.add_argument('file', nargs='?', help="output file (default: stdout)")
+    export.set_defaults(function=doExport, format=None)
+    export.add_argument('--opml', dest='format', action='store_const', const='opml')
+    export.add_argument('--csv', dest='format', action='store_const', const='csv')
+
+    profiles = subparsers.add_parser('profiles',
+            help="rank flows profiled with --profile by wall time or peak memory")
+    profiles.add_argument('--by', choices=['time', 'memory'], default='time')
+    profiles.add_argument('--top', type=int, default=20,
+            help="number of flows to list")
+    profiles.add_argument('--dir', default=constants.PROFILE_DIR,
+            help="profile directory")
+    profiles.set_defaults(function=doProfiles)
+
+    changes = subparsers.add_parser('changes',
+            help="list entries that refreshes added or updated after a sequence number")
+    changes.add_argument('--since', type=int, default=0, metavar='SEQ',
+            help="sequence number of the last change already seen")
+    changes.set_defaults(function=doChanges)
+
+    syncParser = subparsers.add_parser('sync',
+            help="sync subscriptions, entries and seen-state with other machines")
+    transport = syncParser.add_mutually_exclusive_group(required=True)
+    transport.add_argument('--dir', metavar='DIRECTORY',
+            help="sync through a directory shared between the machines")
+    transport.add_argument('--connect', metavar='ADDRESS',
+            help="sync with a machine serving syncs (unix socket path or host:port)")
+    transport.add_argument('--serve', metavar='ADDRESS', nargs='?',
+            const=constants.SYNC_SOCKET_PATH,
+            help="serve syncs until interrupted (default: ~/.youtube_rss/sync-socket)")
+    syncParser.set_defaults(function=doSync)
+
+    migrate = subparsers.add_parser('migrate',
+            help="rewrite the database file in the current format")
+    migrate.set_defaults(function=doMigrate, compress=None)
+    migrate.add_argument('--compress', dest='compress', action='store_const', const=True,
+            help="write the database gzip compressed")
+    migrate.add_argument('--no-compress', dest='compress', action='store_const',
+            const=False, help="write the database uncompressed")
+
+    for subparser in [listUnseen, markSeen, subscribe, refresh, profiles, changes,
+            syncParser]:
+        subparser.add_argument('--format', choices=['json', 'tsv'], default='json',
+                help="output one JSON object or tab separated line per record")
+    return parser
+
+# use this function to run a subcommand, given the command line arguments (without the
+# program name). Returns the exit status
+def main(argv):
+    args = getArgumentParser().parse_args(argv)
+    try:
+        return args.function(args)
+    except FileNotFoundError:
+        print(f"no database found: {constants.DATABASE_PATH}", file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        return 0
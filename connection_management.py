@@ -6,33 +6,254 @@ import urllib
 import subprocess
 from aiohttp_socks import ProxyConnector
 import parser_classes
+import database_management
 from aiohttp_socks import ProxyType
 import time
 import secrets
 import os
+import random
 import shutil
+import re
+import email.utils
+import threading
+import collections
+import concurrent.futures
+from python_socks.sync import Proxy as SyncProxy
+from python_socks import ProxyError, ProxyTimeoutError
 
 
-# manages socks5 auths used for Tor stream isolation
+# manages socks5 auths used for Tor stream isolation.
+# Once startWarmUp has been called, circuits are built in the background: a connection
+# is opened through each fresh auth (so that Tor builds its circuit before the auth is
+# needed), and the next generation of auths is built and warmed up warmUpLead seconds
+# before the current one expires. warmUpFunction is called with each auth to warm up
 class CircuitManager:
-    def __init__(self, nCircuits = 15, ttl = 600):
+    def __init__(self, nCircuits = 15, ttl = 600, warmUpLead = 60,
+            warmUpFunction = None):
         self.ttl = ttl
-        self.nCircuits = 15
+        self.nCircuits = nCircuits
         self.i = 0
         self.expiryTime = 0
+        self.warmUpLead = min(warmUpLead, ttl/2)
+        self.warmUpFunction = warmUpFunction if warmUpFunction is not None \
+                else warmUpCircuit
+        self.nextCircuitAuths = None
+        self.lock = threading.Lock()
+        self.warmUpThread = None
+        self.stopEvent = threading.Event()
 
     def initiateCircuitAuths(self):
         self.circuitAuths=[generateNewSocks5Auth() for i in range(self.nCircuits)]
 
     def getAuth(self):
-        # if ttl is over, reinitiate circuit auth list
-        if self.expiryTime < time.time():
-            self.initiateCircuitAuths()
-            self.expiryTime = time.time() + self.ttl
-        # circulate over the various auths so that you don't use the same circuit all the
-        # time
-        self.i += 1
-        return self.circuitAuths[self.i%self.nCircuits]
+        with self.lock:
+            # if ttl is over, move on to the pre-built generation of circuit auths if
+            # there is one, or else reinitiate circuit auth list
+            if self.expiryTime < time.time():
+                if self.nextCircuitAuths is not None:
+                    self.circuitAuths = self.nextCircuitAuths
+                    self.nextCircuitAuths = None
+                else:
+                    self.initiateCircuitAuths()
+                self.expiryTime = time.time() + self.ttl
+            # circulate over the various auths so that you don't use the same circuit
+            # all the time
+            self.i += 1
+            return self.circuitAuths[self.i%self.nCircuits]
+
+    # start building circuits in the background
+    def startWarmUp(self):
+        if self.warmUpThread is not None:
+            return
+        self.warmUpThread = threading.Thread(target=self.warmUpLoop, daemon=True)
+        self.warmUpThread.start()
+
+    def stopWarmUp(self):
+        self.stopEvent.set()
+
+    def warmUpLoop(self):
+        with self.lock:
+            if self.expiryTime < time.time():
+                self.initiateCircuitAuths()
+                self.expiryTime = time.time() + self.ttl
+            circuitAuths = self.circuitAuths
+        self.warmUpAuths(circuitAuths)
+        while not self.stopEvent.is_set():
+            if self.stopEvent.wait(max(self.expiryTime - self.warmUpLead - time.time(),
+                    0)):
+                return
+            nextCircuitAuths = [generateNewSocks5Auth() for i in range(self.nCircuits)]
+            self.warmUpAuths(nextCircuitAuths)
+            with self.lock:
+                self.nextCircuitAuths = nextCircuitAuths
+            # wait for the pre-built generation to be taken into use
+            if self.stopEvent.wait(max(self.expiryTime - time.time(), 0)):
+                return
+            self.getAuth()
+
+    def warmUpAuths(self, circuitAuths):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nCircuits) as executor:
+            list(executor.map(self.warmUpFunction, circuitAuths))
+
+# use this function to have Tor build the circuit of a socks5 auth ahead of time, by
+# opening (and closing) a connection to YouTube through it
+def warmUpCircuit(auth, host = 'www.youtube.com', port = 443):
+    try:
+        proxy = SyncProxy.create(proxy_type=ProxyType.SOCKS5, host="127.0.0.1",
+                port=9050, username=auth[0], password=auth[1], rdns=True)
+        proxy.connect(dest_host=host, dest_port=port,
+                timeout=constants.CONNECT_TIMEOUT).close()
+        return True
+    except (OSError, ProxyError, ProxyTimeoutError):
+        return False
+
+# limits the number of concurrent HTTP requests, adapting the limit AIMD-style: the
+# limit grows additively (by about one per round of requests) while requests complete
+# quickly, and is cut multiplicatively on 429/5xx responses, timeouts, or latency rising
+# well above the lowest latency seen. While a Retry-After is in effect, no requests are
+# admitted. The limiter can be shared between event loops and threads
+class AdaptiveLimiter:
+    def __init__(self, initialLimit=constants.INITIAL_CONNECTIONS,
+            minLimit=constants.MIN_CONNECTIONS, maxLimit=constants.MAX_CONNECTIONS,
+            backoffFactor=0.5, latencyTolerance=3.0,
+            baselineWindow=constants.LATENCY_BASELINE_WINDOW):
+        self.limit = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.backoffFactor = backoffFactor
+        self.latencyTolerance = latencyTolerance
+        self.baselineWindow = baselineWindow
+        # (time, latency) of recent responses, with increasing latencies, so that the
+        # first one is the lowest latency within the window
+        self.baselineSamples = collections.deque()
+        self.lock = threading.Lock()
+        self.waiters = collections.deque()
+        self.inFlight = 0
+        self.blockedUntil = 0
+        self.lastBackoffTime = 0
+        self.minLatency = None
+        self.smoothedLatency = None
+        self.nRequests = 0
+        self.nOverloads = 0
+        self.nTimeouts = 0
+
+    # get a context manager holding one slot for a request
+    def slot(self):
+        return LimiterSlot(self)
+
+    async def acquire(self):
+        while True:
+            delay = self.blockedUntil - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            loop = asyncio.get_running_loop()
+            with self.lock:
+                if self.inFlight < int(self.limit):
+                    self.inFlight += 1
+                    return
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            await future
+
+    def release(self, latency=None, overloaded=False, timedOut=False, retryAfter=None):
+        with self.lock:
+            self.inFlight -= 1
+            self.nRequests += 1
+            now = time.time()
+            if overloaded or timedOut:
+                self.nOverloads += overloaded
+                self.nTimeouts += timedOut
+                self.backOff(now)
+                if retryAfter is not None:
+                    self.blockedUntil = max(self.blockedUntil, now + retryAfter)
+            elif latency is not None:
+                self.updateBaseline(now, latency)
+                if self.smoothedLatency is None:
+                    self.smoothedLatency = latency
+                else:
+                    self.smoothedLatency = 0.8*self.smoothedLatency + 0.2*latency
+                if self.smoothedLatency > self.latencyTolerance*self.minLatency:
+                    self.backOff(now)
+                else:
+                    self.limit = min(self.maxLimit, self.limit + 1/self.limit)
+            self.wakeWaiters()
+
+    # update the lowest latency seen within the baseline window. A single unusually fast
+    # response only lowers the baseline until it has left the window
+    def updateBaseline(self, now, latency):
+        while self.baselineSamples and self.baselineSamples[-1][1] >= latency:
+            self.baselineSamples.pop()
+        self.baselineSamples.append((now, latency))
+        while self.baselineSamples[0][0] < now - self.baselineWindow:
+            self.baselineSamples.popleft()
+        self.minLatency = self.baselineSamples[0][1]
+
+    # cut the limit, at most once per round trip, so that the requests that were already
+    # in flight when congestion started don't cut it repeatedly
+    def backOff(self, now):
+        if now - self.lastBackoffTime < (self.smoothedLatency or 0):
+            return
+        self.lastBackoffTime = now
+        self.limit = max(self.minLimit, self.limit*self.backoffFactor)
+
+    def wakeWaiters(self):
+        nFree = int(self.limit) - self.inFlight
+        while nFree > 0 and self.waiters:
+            loop, future = self.waiters.popleft()
+            if future.cancelled():
+                continue
+            loop.call_soon_threadsafe(setFutureResult, future)
+            nFree -= 1
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'limit'             : int(self.limit),
+                'in flight'         : self.inFlight,
+                'requests'          : self.nRequests,
+                'overloads'         : self.nOverloads,
+                'timeouts'          : self.nTimeouts,
+                'smoothed latency'  : self.smoothedLatency,
+                'min latency'       : self.minLatency
+            }
+
+# holds one slot of an AdaptiveLimiter while a request is made, and reports how the
+# request went when released
+class LimiterSlot:
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.startTime = None
+        self.overloaded = False
+        self.retryAfter = None
+
+    def reportOverload(self, retryAfter=None):
+        self.overloaded = True
+        self.retryAfter = retryAfter
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.startTime = time.monotonic()
+        return self
+
+    async def __aexit__(self, excType, excValue, traceback):
+        timedOut = excType is not None and issubclass(excType, asyncio.TimeoutError)
+        latency = None
+        if excType is None and not self.overloaded:
+            latency = time.monotonic() - self.startTime
+        self.limiter.release(latency=latency, overloaded=self.overloaded,
+                timedOut=timedOut, retryAfter=self.retryAfter)
+        return False
+
+def setFutureResult(future):
+    if not future.done():
+        future.set_result(None)
+
+# the limiter shared by all feed requests made by this process
+connectionLimiter = AdaptiveLimiter()
+# the limiter for search result and channel pages, which are much slower than feeds and
+# so need a latency baseline of their own
+searchLimiter = AdaptiveLimiter()
 
 # use this function to generate new socks5 authentication (for tor stream 
 # isolation)
@@ -43,34 +264,88 @@ def generateNewSocks5Auth(userNameLen = 30, passwordLen = 30):
     password = "".join([rnd.choice(alphaNumeric) for i in range(passwordLen)])
     return username, password
 
-# use this function to get content (typically hypertext or xml) using HTTP from YouTube
-async def getHttpContent(url, useTor, semaphore, auth=None, contentType='text'):
-    if useTor:
-        if auth is not None:
-            username, password = auth
-        else:
-            username = None
-            password = None
-        connector = ProxyConnector(proxy_type=ProxyType.SOCKS5, host = "127.0.0.1", 
-                port = 9050, username=username, password = password, rdns = True)
+# use this function to get the connector to use for an aiohttp session (None if Tor isn't
+# used)
+def getConnector(useTor, auth=None):
+    if not useTor:
+        return None
+    if auth is not None:
+        username, password = auth
     else:
-        connector = None
+        username = None
+        password = None
+    return ProxyConnector(proxy_type=ProxyType.SOCKS5, host = "127.0.0.1", 
+            port = 9050, username=username, password = password, rdns = True)
+
+# use this function to get the timeout settings used for a single HTTP request
+def getRequestTimeout(connectTimeout=None, readTimeout=None, totalTimeout=None):
+    return aiohttp.ClientTimeout(
+            total = constants.TOTAL_TIMEOUT if totalTimeout is None else totalTimeout,
+            sock_connect = constants.CONNECT_TIMEOUT if connectTimeout is None \
+                    else connectTimeout,
+            sock_read = constants.READ_TIMEOUT if readTimeout is None else readTimeout)
+
+# use this function to get content (typically hypertext or xml) using HTTP from YouTube.
+# Requests are admitted by the limiter, which is told how each request went. Responses
+# telling us to back off (429 and 5xx) are retried up to maxRetries times, after the
+# delay they ask for (or an exponentially growing one), after which ServerOverloaded is
+# raised
+async def getHttpContent(url, useTor, limiter=None, auth=None, contentType='text',
+        timeout=None, maxRetries=None):
+    if limiter is None:
+        limiter = connectionLimiter
+    if timeout is None:
+        timeout = getRequestTimeout()
+    if maxRetries is None:
+        maxRetries = constants.MAX_RETRIES
 
     # This cookie lets us avoid the YouTube consent page
     cookies = {'CONSENT':'YES+'}
     headers = {'Accept-Language':'en-US'}
-    await semaphore.acquire()
-    async with aiohttp.ClientSession(connector=connector, cookies = cookies) as session:
-        session.headers['Accept-Language']='en-US'
-        async with session.get(url, headers=headers) as response:
-            if contentType == 'text':
-                result = await response.text()
-            elif contentType == 'bytes':
-                result = await response.read()
-            else:
-                raise ValueError(f"unknown content type: {contentType}")
-    semaphore.release()
-    return result
+    retryAfter = None
+    for attempt in range(maxRetries+1):
+        if attempt > 0:
+            await asyncio.sleep(getRetryDelay(attempt, retryAfter))
+        connector = getConnector(useTor, auth)
+        async with limiter.slot() as slot:
+            async with aiohttp.ClientSession(connector=connector, cookies = cookies,
+                    timeout = timeout) as session:
+                session.headers['Accept-Language']='en-US'
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 429 or response.status >= 500:
+                        retryAfter = getRetryAfter(response)
+                        slot.reportOverload(retryAfter)
+                        continue
+                    if contentType == 'text':
+                        return await response.text()
+                    elif contentType == 'bytes':
+                        return await response.read()
+                    else:
+                        raise ValueError(f"unknown content type: {contentType}")
+    raise ServerOverloaded(f"server kept answering with status {response.status}: {url}")
+
+# use this function to get the number of seconds a response asks us to wait (from its
+# Retry-After header), or None
+def getRetryAfter(response):
+    retryAfter = response.headers.get('Retry-After')
+    if retryAfter is None:
+        return None
+    try:
+        return float(retryAfter)
+    except ValueError:
+        pass
+    try:
+        retryTime = email.utils.parsedate_to_datetime(retryAfter).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(retryTime - time.time(), 0)
+
+# use this function to get the number of seconds to wait before a retry: as long as the
+# server asked for, or otherwise an exponentially growing delay with jitter
+def getRetryDelay(attempt, retryAfter=None):
+    if retryAfter is not None:
+        return retryAfter
+    return constants.RETRY_BACKOFF * 2**(attempt-1) * random.uniform(0.5, 1.5)
 
 # if you have a channel id, you can use this function to get the rss address
 def getRssAddressFromChannelId(channelId):
@@ -81,9 +356,8 @@ def getRssAddressFromChannelId(channelId):
 async def getChannelQueryResults(query, useTor=False, auth=None):
     url = 'https://youtube.com/results?search_query=' + urllib.parse.quote(query) + \
             '&sp=EgIQAg%253D%253D'
-    semaphore = asyncio.Semaphore(constants.MAX_CONNECTIONS)
-    getTask = asyncio.create_task(getHttpContent(url, useTor=useTor, semaphore=semaphore,
-        auth=auth))
+    getTask = asyncio.create_task(getHttpContent(url, useTor=useTor,
+        limiter=searchLimiter, auth=auth))
     htmlContent = await getTask
     parser = parser_classes.ChannelQueryParser()
     parser.feed(htmlContent)
@@ -94,40 +368,136 @@ async def getChannelQueryResults(query, useTor=False, auth=None):
 async def getVideoQueryResults(query, useTor=False, auth=None):
     url = 'https://youtube.com/results?search_query=' + urllib.parse.quote(query) + \
             '&sp=EgIQAQ%253D%253D'
-    semaphore = asyncio.Semaphore(constants.MAX_CONNECTIONS)
-    getTask = asyncio.create_task(getHttpContent(url, semaphore=semaphore, useTor=useTor, 
-        auth=auth))
+    getTask = asyncio.create_task(getHttpContent(url, useTor=useTor,
+        limiter=searchLimiter, auth=auth))
     htmlContent = await getTask
     parser = parser_classes.VideoQueryParser()
     parser.feed(htmlContent)
 
     return parser.resultList
 
-# use this function to get rss entries from channel id
-async def getRssEntriesFromChannelId(channelId, semaphore, useTor=False, auth=None):
+# use this function to get the channel id from a channel reference (a channel id, an RSS
+# address, a channel URL or a handle) without contacting YouTube, if possible
+def getChannelIdFromReference(reference):
+    reference = reference.strip()
+    match = re.search(r'channel_id=(UC[\w-]{22})', reference)
+    if match is None:
+        match = re.search(r'(?:^|/channel/)(UC[\w-]{22})(?:$|[/?])', reference)
+    if match is not None:
+        return match.group(1)
+    return None
+
+# use this function to get the URL of the channel page that a channel reference points to
+def getChannelUrlFromReference(reference):
+    reference = reference.strip()
+    if reference.startswith('@'):
+        return f"https://www.youtube.com/{reference}"
+    if reference.startswith('http://') or reference.startswith('https://'):
+        return reference
+    return f"https://www.youtube.com/{reference.lstrip('/')}"
+
+# use this function to resolve a channel reference to a ChannelQueryObject, using
+# RssAddressParser on the channel page when the id can't be read off the reference
+async def resolveChannelReference(reference, title=None, useTor=False, auth=None,
+        limiter=None):
+    channelId = getChannelIdFromReference(reference)
+    if channelId is None or title is None:
+        url = getChannelUrlFromReference(reference) if channelId is None else \
+                f"https://www.youtube.com/channel/{channelId}"
+        htmlContent = await getHttpContent(url, useTor,
+                limiter=limiter if limiter is not None else searchLimiter, auth=auth)
+        parser = parser_classes.RssAddressParser()
+        parser.feed(htmlContent)
+        if parser.rssAddress is None:
+            return None
+        channelId = getChannelIdFromReference(parser.rssAddress)
+        if title is None:
+            title = parser.channelTitle
+    if channelId is None:
+        return None
+    return parser_classes.ChannelQueryObject(channelId = channelId,
+            title = title if title is not None else channelId)
+
+# use this function to concurrently resolve a list of (reference, title) tuples into
+# ChannelQueryObjects. References that can't be resolved are returned in a separate list
+async def resolveChannelReferences(references, useTor=False, circuitManager=None):
+    tasks = []
+    for reference, title in references:
+        auth = None
+        if useTor and circuitManager is not None:
+            auth = circuitManager.getAuth()
+        tasks.append(asyncio.create_task(resolveChannelReference(reference,
+            title=title, useTor=useTor, auth=auth)))
+    resolved = []
+    unresolved = []
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for (reference, title), result in zip(references, results):
+        if isinstance(result, parser_classes.ChannelQueryObject):
+            resolved.append(result)
+        else:
+            unresolved.append(reference)
+    return resolved, unresolved
+
+# use this function to get the raw RSS content (as bytes) of a channel from its id
+async def getRssContentFromChannelId(channelId, limiter=None, useTor=False, auth=None,
+        timeout=None):
     rssAddress = getRssAddressFromChannelId(channelId)
-    getTask = asyncio.create_task(getHttpContent(rssAddress, useTor, semaphore=semaphore,
-        auth=auth))
-    rssContent = await getTask
+    getTask = asyncio.create_task(getHttpContent(rssAddress, useTor, limiter=limiter,
+        auth=auth, contentType='bytes', timeout=timeout))
+    return await getTask
+
+# use this function to get rss entries from channel id
+async def getRssEntriesFromChannelId(channelId, limiter=None, useTor=False, auth=None,
+        timeout=None):
+    rssContent = await getRssContentFromChannelId(channelId, limiter, useTor=useTor,
+            auth=auth, timeout=timeout)
     entries = feedparser.parse(rssContent)['entries']
     return entries
 
+# use this function to parse raw RSS content into a list of FeedEntry objects, oldest
+# entry first. It only deals with picklable data, so that it can be run in a process
+# pool
+def parseFeedContent(rssContent):
+    entries = feedparser.parse(rssContent)['entries']
+    entries.reverse()
+    return [database_management.FeedEntry.fromDict(
+        getRelevantDictFromFeedParserDict(entry)) for entry in entries]
 
+# use this function to get the torsocks command prefix used for running a program over
+# an isolated Tor stream
+def getTorsocksCommand(auth):
+    return ['torsocks', '-u', auth[0], '-p', auth[1]]
 
-# use this function to open a YouTube video url in mpv
-def openUrlInMpv(url, useTor=False, maxResolution=1080, circuitManager = None):
+# use this function to open a YouTube video url in mpv. If the video has been downloaded,
+# the local file is played. Otherwise, if a stream resolver has already resolved the
+# streams of the video, mpv is handed the streams directly
+def openUrlInMpv(url, useTor=False, maxResolution=1080, circuitManager = None,
+        streamResolver = None, downloadManager = None):
     try:
         command = []
+        localFile = None
+        if downloadManager is not None:
+            localFile = downloadManager.getLocalFile(url)
+        if localFile is not None:
+            useTor = False
+            streamResolver = None
+        resolved = None
+        if streamResolver is not None:
+            resolved = streamResolver.getResolvedStreams(url, maxResolution)
         if useTor:
-            auth = circuitManager.getAuth()
-            command.append('torsocks')
-            command.append('-u')
-            command.append(auth[0])
-            command.append('-p')
-            command.append(auth[1])
-        command += ['mpv', \
-                f'--ytdl-format=bestvideo[height=?{maxResolution}]+bestaudio/best']
-        command.append(url)
+            # resolved streams must be played over the circuit that resolved them
+            auth = resolved[1] if resolved is not None else circuitManager.getAuth()
+            command += getTorsocksCommand(auth)
+        if localFile is not None:
+            command += ['mpv', '--no-ytdl', f'--force-media-title={url}', localFile]
+        elif resolved is not None:
+            streams = resolved[0]
+            command += ['mpv', '--no-ytdl', f'--force-media-title={url}', streams[0]]
+            command += [f'--audio-file={stream}' for stream in streams[1:]]
+        else:
+            command += ['mpv', \
+                    f'--ytdl-format=bestvideo[height=?{maxResolution}]+bestaudio/best']
+            command.append(url)
         mpvProcess = subprocess.Popen(command, stdout = subprocess.DEVNULL, 
                 stderr = subprocess.STDOUT)
         mpvProcess.wait()
@@ -144,8 +514,17 @@ def getRelevantDictFromFeedParserDict(feedparserDict):
                         'id'        : feedparserDict['id'],
                         'link'      : feedparserDict['link'],
                         'title'     : feedparserDict['title'],
-                        'thumbnail' : feedparserDict['media_thumbnail'][0]['url'],
+                        'thumbnail' : feedparserDict['media_thumbnail'][0]['url']
+                                        if 'media_thumbnail' in feedparserDict else None,
                         'seen'      : False
                     }
     return outputDict
 
+
+"""
+Exception classes
+"""
+
+# indicates that the server kept answering with 429 or 5xx
+class ServerOverloaded(Exception):
+    pass
@@ -4,6 +4,76 @@ HOME = os.environ.get('HOME')
 YOUTUBE_RSS_DIR = '/'.join([HOME,'.youtube_rss'])
 DATABASE_PATH  = '/'.join([YOUTUBE_RSS_DIR, 'database'])
 LOG_PATH = '/'.join([YOUTUBE_RSS_DIR, 'log'])
+MPV_SOCKET_PATH = '/'.join([YOUTUBE_RSS_DIR, 'mpv-socket'])
+DOWNLOAD_DIR = '/'.join([YOUTUBE_RSS_DIR, 'downloads'])
+API_SOCKET_PATH = '/'.join([YOUTUBE_RSS_DIR, 'api-socket'])
+PROFILE_DIR = '/'.join([YOUTUBE_RSS_DIR, 'profiles'])
+CHANGE_LOG_PATH = '/'.join([YOUTUBE_RSS_DIR, 'changelog'])
+SYNC_STATE_PATH = '/'.join([YOUTUBE_RSS_DIR, 'sync-state'])
+SYNC_SOCKET_PATH = '/'.join([YOUTUBE_RSS_DIR, 'sync-socket'])
 
 ANY_INDEX = -1
-MAX_CONNECTIONS=30
+# the number of concurrent connections adapts between these bounds, starting at
+# INITIAL_CONNECTIONS
+INITIAL_CONNECTIONS=30
+MIN_CONNECTIONS=2
+MAX_CONNECTIONS=100
+# times a request answered with 429 or 5xx is retried
+MAX_RETRIES=2
+# delay (in seconds) before the first retry of a response without Retry-After; it doubles
+# with every further retry
+RETRY_BACKOFF=1
+# the latency baseline of the connection limiter is the lowest latency seen over this
+# many seconds
+LATENCY_BASELINE_WINDOW=120
+
+# timeouts (in seconds) applied to every HTTP request
+CONNECT_TIMEOUT=15
+READ_TIMEOUT=30
+TOTAL_TIMEOUT=60
+# maximum time (in seconds) a whole subscription refresh is allowed to take
+REFRESH_DEADLINE=180
+
+# number of upcoming unseen entries whose streams are resolved in the background
+PRERESOLVE_COUNT=3
+# default maximum resolution, used when resolving streams in advance
+DEFAULT_MAX_RESOLUTION=1080
+# fallback lifetime (in seconds) of resolved streams, when their URLs carry no expiry
+STREAM_CACHE_TTL=3600
+
+# bandwidth cap (in bytes per second) for each download, or None for no cap
+DOWNLOAD_RATE_LIMIT=None
+# no new downloads are started while the download directory uses more bytes than this
+DOWNLOAD_DISK_BUDGET=10*1024**3
+# disk space (in bytes) reserved for a download while it runs, until its files are larger
+DOWNLOAD_SIZE_ESTIMATE=500*1024**2
+# maximum number of unseen videos queued when downloading unseen videos
+AUTO_DOWNLOAD_COUNT=10
+
+# refreshes of at least this many channels parse feeds in a pool of processes
+PARSE_POOL_THRESHOLD=50
+# maximum number of fetched feeds waiting to be parsed during a refresh
+PARSE_QUEUE_SIZE=60
+
+# whether the database file is written gzip compressed (either format is read), or None
+# to keep writing it the way it is (see the migrate subcommand)
+COMPRESS_DATABASE=None
+# the change log is compacted once it grows beyond this many bytes, keeping at most
+# CHANGE_LOG_MAX_RECORDS records
+CHANGE_LOG_COMPACT_SIZE=8*1024**2
+CHANGE_LOG_MAX_RECORDS=50000
+# profiles of flows that take less wall time (in seconds) than this aren't written
+PROFILE_MIN_WALL_TIME=0.05
+
+# WebSub hub that YouTube feeds publish to, used by the server in push mode
+WEBSUB_HUB_URL='https://pubsubhubbub.appspot.com/subscribe'
+# address the callback receiver for pushed feeds listens on
+WEBSUB_LISTEN_HOST='127.0.0.1'
+WEBSUB_LISTEN_PORT=8090
+# requested lifetime (in seconds) of hub subscriptions, and how long before they expire
+# they are renewed
+WEBSUB_LEASE_SECONDS=5*24*3600
+WEBSUB_RENEW_MARGIN=24*3600
+# interval (in seconds) of the polling sweep that catches pushes that got lost
+WEBSUB_SWEEP_INTERVAL=6*3600
+WEBSUB_STATE_PATH = '/'.join([YOUTUBE_RSS_DIR, 'websub-state'])
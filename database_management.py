@@ -2,27 +2,514 @@ import json
 import os
 import constants
 import asyncio
-import connection_management
+import concurrent.futures
+import gzip
+import fcntl
+import threading
+import contextlib
+import collections
 
-# Database is always stored as a dict()
+# Database is always stored as a dict(). Feeds are lists of FeedEntry objects, newest
+# entry first.
+#
+# On disk, the database is stored as compact json (schema version DATABASE_VERSION),
+# optionally gzip compressed. Each entry is stored as [video id, title, seen], since
+# its id, link and thumbnail can all be derived from the video id. Files written in the
+# original format (one dict with full URLs per entry) are migrated when read
+
+DATABASE_VERSION = 2
+GZIP_MAGIC = b'\x1f\x8b'
+
+# When an API server is running, the database is accessed through this client instead
+# of the database file (see useApiClient)
+apiClient = None
+
+# seen-states of the most recently loaded databases, as they were when loaded from the
+# API server, by id of the database (see saveDatabase)
+apiSnapshots = collections.OrderedDict()
+MAX_API_SNAPSHOTS = 8
+
+# Serializes loading, saving and merging of feeds into databases, since a database can
+# also be changed from a background thread (see getMarkAsSeenCallback in youtube_rss)
+databaseLock = threading.RLock()
+
+# DatabaseCache objects by database filename (see getDatabaseCache)
+databaseCaches = {}
+
+# ChangeLog objects by log filename (see getChangeLog)
+changeLogs = {}
+
+"""
+classes
+"""
+
+# contains one entry of a feed. Only the fields that can't be derived from the video id
+# are stored; for compatibility, the entry can be indexed like the dicts entries used
+# to be stored as
+class FeedEntry:
+    __slots__ = ('videoId', 'title', 'seen')
+    fields = ('id', 'link', 'title', 'thumbnail', 'seen')
+
+    def __init__(self, videoId, title, seen=False):
+        self.videoId = videoId
+        self.title = title
+        self.seen = seen
+
+    @property
+    def id(self):
+        return f"yt:video:{self.videoId}"
+
+    @property
+    def link(self):
+        return f"https://www.youtube.com/watch?v={self.videoId}"
+
+    @property
+    def thumbnail(self):
+        return f"https://i4.ytimg.com/vi/{self.videoId}/hqdefault.jpg"
+
+    def __getitem__(self, key):
+        if key not in FeedEntry.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in ['title', 'seen']:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in FeedEntry.fields
+
+    def update(self, values):
+        for key, value in values.items():
+            self[key] = value
+
+    def toDict(self):
+        return {key: self[key] for key in FeedEntry.fields}
+
+    def toCompact(self):
+        return [self.videoId, self.title, 1 if self.seen else 0]
+
+    @staticmethod
+    def fromCompact(compactEntry):
+        videoId, title, seen = compactEntry
+        return FeedEntry(videoId, title, bool(seen))
+
+    # create an entry from a dict in the original format
+    @staticmethod
+    def fromDict(entryDict):
+        return FeedEntry(getVideoIdFromEntryId(entryDict['id']), entryDict['title'],
+                entryDict.get('seen', False))
+
+# keeps one loaded copy of a database file in memory, which is only reloaded when the
+# file has been changed (by its modification time, size or inode). Reloading and saving
+# merge the changes made in memory with those made to the file by other processes
+# (under an advisory lock), so that no updates are lost: subscriptions, channel titles,
+# seen-states and the unreached channels are merged three-way against the state last
+# synced with the file (with our changes winning), and new entries from either side
+# are kept. The loaded database is updated in place, so that objects
+# referring to its entries stay valid
+class DatabaseCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.database = None
+        self.fileState = None
+        self.baseTitles = {}
+        self.baseSeen = {}
+        self.baseUnreached = []
+
+    def getFileState(self):
+        fileStat = os.stat(self.filename)
+        return (fileStat.st_mtime_ns, fileStat.st_size, fileStat.st_ino)
+
+    # get the loaded database, reloading it first if the file has changed
+    def load(self):
+        with lockDatabaseFile(self.filename, exclusive=False):
+            self.syncWithFile()
+        return self.database
+
+    # write the loaded database to the file, merging in changes made to the file since
+    # it was last loaded
+    def save(self):
+        with lockDatabaseFile(self.filename, exclusive=True):
+            self.syncWithFile()
+            outputDatabaseToFile(self.database, self.filename)
+            self.fileState = self.getFileState()
+            self.setBase(self.database)
+
+    def syncWithFile(self):
+        fileState = self.getFileState()
+        if self.database is None:
+            self.database = parseDatabaseFile(self.filename)
+            self.setBase(self.database)
+        elif fileState != self.fileState:
+            theirs = parseDatabaseFile(self.filename)
+            self.mergeDatabase(theirs)
+            self.setBase(theirs)
+        self.fileState = fileState
+
+    def setBase(self, database):
+        self.baseTitles = dict(database['id to title'])
+        self.baseSeen = {entry['id']: entry['seen'] for feed in
+                database['feeds'].values() for entry in feed}
+        self.baseUnreached = list(database.get('unreached', []))
+
+    def mergeDatabase(self, theirs):
+        ours = self.database
+        for channelId in list(ours['id to title']):
+            if channelId in self.baseTitles and channelId not in theirs['id to title']:
+                # removed by someone else
+                channelTitle = ours['id to title'].pop(channelId)
+                ours['title to id'].pop(channelTitle, None)
+                ours['feeds'].pop(channelId, None)
+        for channelId, channelTitle in theirs['id to title'].items():
+            if channelId not in ours['id to title']:
+                if channelId in self.baseTitles:
+                    # removed by us
+                    continue
+                ours['id to title'][channelId] = channelTitle
+                ours['title to id'][channelTitle] = channelId
+                ours['feeds'][channelId] = []
+            elif ours['id to title'][channelId] == self.baseTitles.get(channelId):
+                # the title is only taken from the file if we haven't changed it
+                if ours['title to id'].get(ours['id to title'][channelId]) == channelId:
+                    ours['title to id'].pop(ours['id to title'][channelId])
+                ours['id to title'][channelId] = channelTitle
+                ours['title to id'][channelTitle] = channelId
+            self.mergeFeed(ours['feeds'][channelId], theirs['feeds'][channelId])
+        if ours.get('unreached', []) == self.baseUnreached:
+            # the unreached channels are only taken from the file if we haven't
+            # refreshed since
+            ours['unreached'] = theirs.get('unreached', [])
+
+    def mergeFeed(self, ourFeed, theirFeed):
+        ourEntries = {entry['id']: entry for entry in ourFeed}
+        newEntries = []
+        for theirEntry in theirFeed:
+            ourEntry = ourEntries.get(theirEntry['id'])
+            if ourEntry is None:
+                newEntries.append(theirEntry)
+            elif ourEntry['seen'] == self.baseSeen.get(ourEntry['id'], not ourEntry['seen']):
+                # the seen-state is only taken from the file if we haven't changed it
+                ourEntry['seen'] = theirEntry['seen']
+        ourFeed[0:0] = newEntries
+
+# append-only log of the entries that refreshes have added or updated, so that anything
+# that wants to know what arrived since it last looked (a status bar, a notifier, another
+# client) can read just that, with since(seq), rather than load and diff the database.
+# Each line of the file is a json record {"seq", "channelId", "change", "entry"}, where
+# change is 'new' or 'updated' and entry is the compact entry; records should be treated
+# as upserts of the entry. The first line may be a header {"floor": seq}, written when
+# the log is compacted: compaction keeps only the latest record of every entry (with its
+# sequence number) and at most maxRecords records, and the floor is the sequence number
+# below which records may have been dropped
+class ChangeLog:
+    def __init__(self, filename, maxRecords=constants.CHANGE_LOG_MAX_RECORDS,
+            compactSize=constants.CHANGE_LOG_COMPACT_SIZE):
+        self.filename = filename
+        self.maxRecords = maxRecords
+        self.compactSize = compactSize
+        self.pending = []
+        # guards pending, which is filled and flushed from several threads in the server
+        self.pendingLock = threading.Lock()
+        # serializes flushes within the process (the file lock only works between
+        # processes), so that sequence numbers are handed out in order
+        self.flushLock = threading.Lock()
+
+    # buffer a change, until it is written by flush
+    def record(self, channelId, change, entry):
+        with self.pendingLock:
+            self.pending.append((channelId, change, entry))
+
+    # append the buffered changes to the log, compacting it if it has grown too large.
+    # Returns the sequence number of the last change
+    def flush(self):
+        with self.flushLock, lockDatabaseFile(self.filename, exclusive=True):
+            with self.pendingLock:
+                pending = self.pending
+                self.pending = []
+            seq = self.getLastSequenceNumber()
+            if not pending:
+                return seq
+            lines = []
+            for channelId, change, entry in pending:
+                seq += 1
+                lines.append(json.dumps({'seq': seq, 'channelId': channelId,
+                    'change': change, 'entry': entry.toCompact()},
+                    separators=(',', ':')) + '\n')
+            with open(self.filename, 'a') as filePointer:
+                filePointer.write(''.join(lines))
+                filePointer.flush()
+                os.fsync(filePointer.fileno())
+            if os.path.getsize(self.filename) > self.compactSize:
+                self.compact()
+        return seq
+
+    # get the changes with a sequence number above seq, oldest first. Raises
+    # ChangeLogTruncated if changes after seq may have been dropped by compaction, in
+    # which case the whole database has to be read instead, after which reading can
+    # continue from the last sequence number it carries
+    def since(self, seq):
+        with lockDatabaseFile(self.filename, exclusive=False):
+            if not os.path.isfile(self.filename):
+                return []
+            with open(self.filename, 'rb') as filePointer:
+                floor = parseChangeLogLine(filePointer.readline()).get('floor', 0)
+                if seq < floor:
+                    raise ChangeLogTruncated(f"changes after {seq} have been " + \
+                            f"compacted away (the log starts after {floor})",
+                            self.getLastSequenceNumber())
+                offset = self.findOffset(filePointer, seq)
+                filePointer.seek(offset)
+                if offset > 0:
+                    filePointer.readline()
+                changes = []
+                for line in filePointer:
+                    record = parseChangeLogLine(line)
+                    if record.get('seq', 0) > seq:
+                        record['entry'] = FeedEntry.fromCompact(record['entry'])
+                        changes.append(record)
+                return changes
+
+    # get the sequence number of the last change (0 for an empty log)
+    def getLastSequenceNumber(self):
+        if not os.path.isfile(self.filename):
+            return 0
+        with open(self.filename, 'rb') as filePointer:
+            size = filePointer.seek(0, os.SEEK_END)
+            blockSize = 4096
+            while True:
+                filePointer.seek(max(size - blockSize, 0))
+                lines = filePointer.read().splitlines()
+                if len(lines) > 1 or blockSize >= size:
+                    break
+                blockSize *= 2
+        if not lines:
+            return 0
+        record = parseChangeLogLine(lines[-1])
+        return record['seq'] if 'seq' in record else record.get('floor', 0)
+
+    # find, by bisection, an offset from which all lines after the first newline have a
+    # sequence number above seq, or are preceded only by lines with sequence numbers of
+    # at most seq. Reading from there costs work proportional to the number of changes
+    # after seq, rather than to the size of the log
+    def findOffset(self, filePointer, seq, blockSize=64*1024):
+        low = 0
+        high = filePointer.seek(0, os.SEEK_END)
+        while high - low > blockSize:
+            middle = (low + high)//2
+            filePointer.seek(middle)
+            filePointer.readline()
+            record = parseChangeLogLine(filePointer.readline())
+            if not record or record.get('seq', 0) > seq:
+                high = middle
+            else:
+                low = middle
+        return low
+
+    def compact(self):
+        floor = 0
+        latestRecords = {}
+        with open(self.filename, 'rb') as filePointer:
+            for line in filePointer:
+                record = parseChangeLogLine(line)
+                if 'floor' in record:
+                    floor = record['floor']
+                    continue
+                key = (record['channelId'], record['entry'][0])
+                latestRecords.pop(key, None)
+                latestRecords[key] = record
+        records = sorted(latestRecords.values(), key=lambda record: record['seq'])
+        if len(records) > self.maxRecords:
+            floor = records[-self.maxRecords-1]['seq']
+            records = records[-self.maxRecords:]
+        temporaryFilename = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temporaryFilename, 'w') as filePointer:
+            filePointer.write(json.dumps({'floor': floor}) + '\n')
+            for record in records:
+                filePointer.write(json.dumps(record, separators=(',', ':')) + '\n')
+            filePointer.flush()
+            os.fsync(filePointer.fileno())
+        os.replace(temporaryFilename, self.filename)
+
+"""
+functions
+"""
+
+# use this function to get the change log of a database
+def getChangeLog(filename=constants.CHANGE_LOG_PATH):
+    if filename not in changeLogs:
+        changeLogs[filename] = ChangeLog(filename)
+    return changeLogs[filename]
+
+# use this function to get the changes (new and updated entries) made to the database
+# after the change with sequence number seq (see ChangeLog.since)
+def since(seq, filename=constants.CHANGE_LOG_PATH):
+    return getChangeLog(filename).since(seq)
+
+def parseChangeLogLine(line):
+    line = line.strip()
+    return json.loads(line) if line else {}
+
+# use this function to hold an advisory lock on a database file, shared for reading or
+# exclusive for writing. A separate lock file is used, since the database file is
+# replaced when written
+@contextlib.contextmanager
+def lockDatabaseFile(filename, exclusive=True):
+    with open(filename + '.lock', 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+# use this function to get the cache of a database file
+def getDatabaseCache(filename=constants.DATABASE_PATH):
+    if filename not in databaseCaches:
+        databaseCaches[filename] = DatabaseCache(filename)
+    return databaseCaches[filename]
+
+# use this function to make database access go through an api_client.ApiClient
+def useApiClient(client):
+    global apiClient
+    apiClient = client
+
+# use this function to get the video id from an entry id (yt:video:<video id>)
+def getVideoIdFromEntryId(entryId):
+    return entryId.split(':')[-1]
+
+# use this function to get the compact, json serializable representation of a database
+def encodeDatabase(database):
+    return {
+        'version'       : DATABASE_VERSION,
+        'feeds'         : {channelId: [entry.toCompact() for entry in feed]
+                            for channelId, feed in database['feeds'].items()},
+        'id to title'   : database['id to title'],
+        'unreached'     : database.get('unreached', [])
+    }
+
+# use this function to get a database from its json representation, in either the
+# compact or the original format
+def decodeDatabase(content):
+    database = initiateYouTubeRssDatabase()
+    if content.get('version', 1) == 1:
+        database['feeds'] = {channelId: [FeedEntry.fromDict(entry) for entry in feed]
+                for channelId, feed in content['feeds'].items()}
+    elif content['version'] == DATABASE_VERSION:
+        database['feeds'] = {channelId: [FeedEntry.fromCompact(entry) for entry in feed]
+                for channelId, feed in content['feeds'].items()}
+    else:
+        raise UnknownDatabaseVersion(f"unknown database version: {content['version']}")
+    database['id to title'] = content['id to title']
+    database['title to id'] = {channelTitle: channelId for channelId, channelTitle
+            in content['id to title'].items()}
+    database['unreached'] = content.get('unreached', [])
+    return database
 
 # use this function to read database from json string
 def parseDatabaseContent(content):
+    return decodeDatabase(json.loads(content))
+
+# use this function to read the json representation of a database from a file (which
+# may be gzip compressed), without decoding it
+def readDatabaseContent(filename):
+    with open(filename, 'rb') as filePointer:
+        content = filePointer.read()
+    if content[:2] == GZIP_MAGIC:
+        content = gzip.decompress(content)
     return json.loads(content)
 
-# use this function to read database from json file
+# use this function to read database from json file (which may be gzip compressed)
 def parseDatabaseFile(filename):
-    with open(filename, 'r') as filePointer:
-        return json.load(filePointer)
+    return decodeDatabase(readDatabaseContent(filename))
+
+# use this function to get the unseen entries of a database in its json representation
+# as (channel id, entry) pairs, without decoding the entries that are seen
+def getUnseenEntries(content, channelIdList=None):
+    version = content.get('version', 1)
+    if version not in [1, DATABASE_VERSION]:
+        raise UnknownDatabaseVersion(f"unknown database version: {version}")
+    for channelId, feed in content['feeds'].items():
+        if channelIdList and channelId not in channelIdList:
+            continue
+        for entry in feed:
+            if version == 1 and not entry.get('seen', False):
+                yield channelId, FeedEntry.fromDict(entry)
+            elif version == DATABASE_VERSION and not entry[2]:
+                yield channelId, FeedEntry.fromCompact(entry)
 
 # use this function to return json representation of database as string
 def getDatabaseString(database):
-    return json.dumps(database, indent=4)
+    return json.dumps(encodeDatabase(database), separators=(',', ':'))
+
+# use this function to write json representation of database to file, gzip compressed
+# if compress is set (by default, if constants.COMPRESS_DATABASE is set, or if it is
+# None, if the file is already gzip compressed). The file is
+# replaced atomically, so that readers never see a partially written database
+def outputDatabaseToFile(database, filename, compress=None):
+    if compress is None:
+        compress = constants.COMPRESS_DATABASE
+    if compress is None:
+        compress = isCompressedFile(filename)
+    content = getDatabaseString(database).encode()
+    if compress:
+        content = gzip.compress(content)
+    temporaryFilename = f"{filename}.{os.getpid()}.tmp"
+    with open(temporaryFilename, 'wb') as filePointer:
+        filePointer.write(content)
+        filePointer.flush()
+        os.fsync(filePointer.fileno())
+    os.replace(temporaryFilename, filename)
 
-# use this function to write json representation of database to file
-def outputDatabaseToFile(database, filename):
-    with open(filename, 'w') as filePointer:
-        return json.dump(database, filePointer, indent=4)
+# use this function to check if a file is gzip compressed (False if it doesn't exist)
+def isCompressedFile(filename):
+    try:
+        with open(filename, 'rb') as filePointer:
+            return filePointer.read(2) == GZIP_MAGIC
+    except FileNotFoundError:
+        return False
+
+# use this function to migrate a database file to the current format, gzip compressed
+# if compress is set (see outputDatabaseToFile)
+def migrateDatabaseFile(filename, compress=None):
+    with lockDatabaseFile(filename, exclusive=True):
+        outputDatabaseToFile(parseDatabaseFile(filename), filename, compress=compress)
+
+# use this function to load the database, from the API server if one is used, or
+# otherwise from the in-memory cache of the database file (which is only re-read if
+# the file has changed)
+def loadDatabase():
+    with databaseLock:
+        if apiClient is not None:
+            database = apiClient.getDatabase()
+            apiSnapshots[id(database)] = (database, {video['id']: video['seen']
+                for feed in database['feeds'].values() for video in feed})
+            while len(apiSnapshots) > MAX_API_SNAPSHOTS:
+                apiSnapshots.popitem(last=False)
+            return database
+        return getDatabaseCache(constants.DATABASE_PATH).load()
+
+# use this function to save changes made to a loaded database. When an API server is
+# used, only the seen-states changed since the database was loaded are sent, since the
+# server owns everything else (and other clients may have changed other entries since)
+def saveDatabase(database):
+    with databaseLock:
+        if apiClient is not None:
+            snapshot = apiSnapshots.get(id(database))
+            seenAsLoaded = snapshot[1] \
+                    if snapshot is not None and snapshot[0] is database else {}
+            changed = {video['id']: video['seen'] for feed in database['feeds'].values()
+                    for video in feed if seenAsLoaded.get(video['id']) != video['seen']}
+            if changed:
+                apiClient.setSeen(changed)
+                seenAsLoaded.update(changed)
+            return
+        databaseCache = getDatabaseCache(constants.DATABASE_PATH)
+        if database is databaseCache.database:
+            databaseCache.save()
+        else:
+            with lockDatabaseFile(constants.DATABASE_PATH, exclusive=True):
+                outputDatabaseToFile(database, constants.DATABASE_PATH)
 
 # use this function to initialize the database (dict format so it's easy to save as json)
 def initiateYouTubeRssDatabase():
@@ -30,6 +517,7 @@ def initiateYouTubeRssDatabase():
     database['feeds'] = {}
     database['id to title'] = {}
     database['title to id'] = {}
+    database['unreached'] = []
     return database
 
 # use this function to remove a subscription from the database by channel title
@@ -47,60 +535,193 @@ def removeSubscriptionFromDatabaseByChannelId(database, channelId):
     channelTitle = database['id to title'].pop(channelId)
     database['title to id'].pop(channelTitle)
     database['feeds'].pop(channelId)
-    outputDatabaseToFile(database, constants.DATABASE_PATH)
+    if apiClient is not None:
+        apiClient.unsubscribe(channelId)
+    else:
+        saveDatabase(database)
+
+# use this function to order channel ids so that channels which weren't reached during
+# the previous refresh are refreshed first
+def getRefreshOrder(database, channelIdList):
+    unreached = [channelId for channelId in database.get('unreached', [])
+            if channelId in channelIdList]
+    return unreached + [channelId for channelId in channelIdList
+            if channelId not in unreached]
 
 # use this function to retrieve new RSS entries for a subscription and add them to
-# a database
+# a database. If the deadline (in seconds) is reached, the refresh finishes with
+# whatever has completed, and the channels that weren't reached are returned (and
+# scheduled first during the next refresh). Channels whose refresh failed are returned
+# as unreached too, so that one failing channel doesn't lose the refreshed ones.
+# The event loop only fetches feeds; parsing them is fanned out to a process pool for
+# large refreshes (or to parseExecutor, if provided), with at most parseQueueSize
+# fetched feeds waiting to be parsed at any time.
+# If a database is provided, it is refreshed in place instead of the database file.
+# New and updated entries are appended to changeLog (by default, the change log of the
+# database file).
 async def refreshSubscriptionsByChannelId(channelIdList, useTor=False, 
-        auth=None):
-    database = parseDatabaseFile(constants.DATABASE_PATH)
+        auth=None, deadline=None, timeout=None, parseExecutor=None,
+        parseQueueSize=None, database=None, changeLog=None):
+    ownsDatabase = database is None
+    if ownsDatabase:
+        database = loadDatabase()
     localFeeds = database['feeds']
-    tasks = []
-
-    semaphore = asyncio.Semaphore(constants.MAX_CONNECTIONS)
-
-    for channelId in channelIdList:
-        localFeed = localFeeds[channelId]
-        tasks.append(asyncio.create_task(refreshSubscriptionByChannelId(channelId, localFeed, 
-            semaphore=semaphore, useTor=useTor, auth=auth)))
-
-    for task in tasks:
-        await task
-
-    outputDatabaseToFile(database, constants.DATABASE_PATH)
-
-async def refreshSubscriptionByChannelId(channelId, localFeed, semaphore, useTor=False,
-        auth=None):
-    task = asyncio.create_task(connection_management.getRssEntriesFromChannelId(channelId, 
-            semaphore=semaphore, useTor=useTor, auth=auth))
-    remoteFeed = await task
-    if remoteFeed is not None:
-        remoteFeed.reverse()
-        for entry in remoteFeed:
-            filteredEntry = connection_management.getRelevantDictFromFeedParserDict(entry)
-
-            filteredEntryIsNew = True
-            for i, localEntry in enumerate(localFeed):
-                if localEntry['id'] == filteredEntry['id']:
-                    filteredEntryIsNew = False
-                    # in case any relevant data about the entry is changed, update it
-                    filteredEntry['seen'] = localEntry['seen']
-                    localFeed[i] = filteredEntry
-                    break
-            if filteredEntryIsNew:
-                localFeed.insert(0, filteredEntry)
+    if deadline is None:
+        deadline = constants.REFRESH_DEADLINE
+    if parseQueueSize is None:
+        parseQueueSize = constants.PARSE_QUEUE_SIZE
+    if changeLog is None:
+        changeLog = getChangeLog()
+    tasks = {}
+
+    # a feed holds a slot from before it is fetched until it has been parsed, which
+    # bounds the number of feeds in flight between the fetching and parsing stages
+    pipelineSemaphore = asyncio.Semaphore(constants.MAX_CONNECTIONS + parseQueueSize)
+
+    ownsParseExecutor = parseExecutor is None and \
+            len(channelIdList) >= constants.PARSE_POOL_THRESHOLD
+    if ownsParseExecutor:
+        parseExecutor = concurrent.futures.ProcessPoolExecutor()
+
+    try:
+        for channelId in getRefreshOrder(database, channelIdList):
+            localFeed = localFeeds[channelId]
+            tasks[channelId] = asyncio.create_task(refreshSubscriptionByChannelId(
+                channelId, localFeed, useTor=useTor, auth=auth,
+                timeout=timeout, parseExecutor=parseExecutor,
+                pipelineSemaphore=pipelineSemaphore, changeLog=changeLog))
+
+        unreached = []
+        if tasks:
+            done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+            for task in pending:
+                task.cancel()
+            for channelId, task in tasks.items():
+                if task in pending or task.exception() is not None:
+                    unreached.append(channelId)
+    finally:
+        if ownsParseExecutor:
+            parseExecutor.shutdown(wait=False, cancel_futures=True)
+
+    database['unreached'] = unreached
+    if ownsDatabase:
+        saveDatabase(database)
+    changeLog.flush()
+    return unreached
+
+# (connection_management is imported here rather than at the top of the module, so that
+# scripts which only read the database don't pay for importing the networking libraries)
+async def refreshSubscriptionByChannelId(channelId, localFeed, limiter=None, useTor=False,
+        auth=None, timeout=None, parseExecutor=None, pipelineSemaphore=None,
+        changeLog=None):
+    import connection_management
+    if pipelineSemaphore is None:
+        pipelineSemaphore = asyncio.Semaphore(1)
+    async with pipelineSemaphore:
+        rssContent = await connection_management.getRssContentFromChannelId(channelId,
+                limiter=limiter, useTor=useTor, auth=auth, timeout=timeout)
+        if rssContent is None:
+            return
+        if parseExecutor is not None:
+            filteredEntries = await asyncio.get_running_loop().run_in_executor(
+                    parseExecutor, connection_management.parseFeedContent, rssContent)
+        else:
+            filteredEntries = connection_management.parseFeedContent(rssContent)
+    updatedEntries = []
+    with databaseLock:
+        newEntries = mergeEntriesIntoFeed(localFeed, filteredEntries, updatedEntries)
+    if changeLog is not None:
+        recordChanges(changeLog, channelId, newEntries, updatedEntries)
+
+# use this function to record new and updated entries of a feed in a change log
+def recordChanges(changeLog, channelId, newEntries, updatedEntries):
+    for entry in newEntries:
+        changeLog.record(channelId, 'new', entry)
+    for entry in updatedEntries:
+        changeLog.record(channelId, 'updated', entry)
+
+# use this function to merge filtered entries (oldest first) into a local feed (newest
+# first). Entries already in the feed are updated in place (keeping their seen-state),
+# and new entries are put first. Returns the new entries; entries whose title changed
+# are added to updatedEntries, if given
+def mergeEntriesIntoFeed(localFeed, filteredEntries, updatedEntries=None):
+    indexById = {}
+    for i, localEntry in enumerate(localFeed):
+        indexById.setdefault(localEntry['id'], i)
+    newEntries = {}
+    for filteredEntry in filteredEntries:
+        if filteredEntry['id'] in indexById:
+            i = indexById[filteredEntry['id']]
+            # in case any relevant data about the entry is changed, update it
+            filteredEntry['seen'] = localFeed[i]['seen']
+            if updatedEntries is not None and \
+                    filteredEntry['title'] != localFeed[i]['title']:
+                updatedEntries.append(filteredEntry)
+            localFeed[i] = filteredEntry
+        elif filteredEntry['id'] in newEntries:
+            filteredEntry['seen'] = newEntries[filteredEntry['id']]['seen']
+            newEntries[filteredEntry['id']] = filteredEntry
+        else:
+            newEntries[filteredEntry['id']] = filteredEntry
+    newEntries = list(newEntries.values())
+    localFeed[0:0] = reversed(newEntries)
+    return newEntries
 
 # use this function to add a subscription to the database
 def addSubscriptionToDatabase(channelId, channelTitle, refresh=False,
         useTor=False, circuitManager=None):
-    database = parseDatabaseFile(constants.DATABASE_PATH)
+    if apiClient is not None:
+        apiClient.subscribe(channelId, channelTitle, refresh=refresh)
+        return
+    database = loadDatabase()
     database['feeds'][channelId] = []
     database['id to title'][channelId] = channelTitle
     database['title to id'][channelTitle] = channelId
-    outputDatabaseToFile(database, constants.DATABASE_PATH)
+    saveDatabase(database)
     auth = None
     if circuitManager is not None and useTor:
         auth = circuitManager.getAuth()
     if refresh:
         asyncio.run(refreshSubscriptionsByChannelId( [channelId], useTor=useTor, 
                 auth=auth))
+
+# use this function to add several subscriptions to the database with a single write,
+# optionally followed by a single batched refresh. Channels that are already
+# subscribed to are skipped. Returns the channel ids that were added
+def addSubscriptionsToDatabase(channels, refresh=False, useTor=False,
+        circuitManager=None):
+    if apiClient is not None:
+        return apiClient.subscribeChannels([(channel.channelId, channel.title)
+            for channel in channels], refresh=refresh)
+    database = loadDatabase()
+    addedChannelIds = []
+    for channel in channels:
+        if channel.channelId in database['feeds']:
+            continue
+        database['feeds'][channel.channelId] = []
+        database['id to title'][channel.channelId] = channel.title
+        database['title to id'][channel.title] = channel.channelId
+        addedChannelIds.append(channel.channelId)
+    saveDatabase(database)
+    auth = None
+    if circuitManager is not None and useTor:
+        auth = circuitManager.getAuth()
+    if refresh and addedChannelIds:
+        asyncio.run(refreshSubscriptionsByChannelId(addedChannelIds, useTor=useTor,
+                auth=auth))
+    return addedChannelIds
+
+"""
+Exception classes
+"""
+
+# indicates that the database file was written by a newer version of the program
+class UnknownDatabaseVersion(Exception):
+    pass
+
+# indicates that changes asked for have been dropped from the change log by compaction;
+# lastSequenceNumber is the sequence number of the last change in the log
+class ChangeLogTruncated(Exception):
+    def __init__(self, message, lastSequenceNumber):
+        self.lastSequenceNumber = lastSequenceNumber
+        Exception.__init__(self, message)
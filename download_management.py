@@ -0,0 +1,199 @@
+import os
+import re
+import glob
+import threading
+import subprocess
+import concurrent.futures
+import constants
+import connection_management
+
+"""
+classes
+"""
+
+# contains the state of one queued download
+class DownloadJob:
+    def __init__(self, url, title=None):
+        self.url = url
+        self.title = title if title is not None else url
+        self.videoId = getVideoIdFromUrl(url)
+        self.state = 'queued'
+        self.progress = 0.0
+        self.future = None
+
+    def __str__(self):
+        return f"{self.title}: {self.state} ({self.progress*100:.1f}%)"
+
+# downloads videos in the background using a bounded pool of workers, so that they can
+# be watched from local disk. downloader is called as
+# downloader(url, outputTemplate, rateLimit, auth, onProgress, stopEvent) and should
+# download the video to outputTemplate (with '%(ext)s' replaced by the file extension),
+# resuming partial downloads if possible, call onProgress with a fraction between 0 and
+# 1, and give up as soon as stopEvent is set (which happens on shutdown).
+# Every running download reserves expectedSize bytes of the disk budget (or the size of
+# its files, if larger), so that downloads running at the same time can't overshoot it
+class DownloadManager:
+    def __init__(self, downloadDir=constants.DOWNLOAD_DIR, maxWorkers=2,
+            rateLimit=constants.DOWNLOAD_RATE_LIMIT,
+            diskBudget=constants.DOWNLOAD_DISK_BUDGET,
+            expectedSize=constants.DOWNLOAD_SIZE_ESTIMATE, useTor=False,
+            circuitManager=None, downloader=None):
+        self.downloadDir = downloadDir
+        self.rateLimit = rateLimit
+        self.diskBudget = diskBudget
+        self.expectedSize = expectedSize
+        self.useTor = useTor
+        self.circuitManager = circuitManager
+        self.downloader = downloader if downloader is not None \
+                else downloadWithYoutubeDl
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.jobs = {}
+        self.runningVideoIds = set()
+
+    # queue downloads of the given videos (videos that are already queued or downloaded
+    # are skipped)
+    def queue(self, videos):
+        with self.lock:
+            for video in videos:
+                url = video['link']
+                if url in self.jobs and self.jobs[url].state not in ['failed',
+                        'over disk budget', 'cancelled']:
+                    continue
+                if self.getLocalFile(url) is not None:
+                    continue
+                job = DownloadJob(url, title=video['title'])
+                job.future = self.executor.submit(self.runJob, job)
+                self.jobs[url] = job
+
+    # queue downloads of up to maxCount unseen videos from the given feeds
+    def queueUnseen(self, feeds, maxCount=constants.AUTO_DOWNLOAD_COUNT):
+        unseen = [video for feed in feeds for video in feed if not video['seen']]
+        self.queue(unseen[:maxCount])
+
+    def getJobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    # get the path of the downloaded file of a url, or None if it hasn't been downloaded
+    def getLocalFile(self, url):
+        videoId = getVideoIdFromUrl(url)
+        if videoId is None:
+            return None
+        for path in glob.glob(os.path.join(glob.escape(self.downloadDir),
+                f"{glob.escape(videoId)}.*")):
+            if not isPartialFile(path):
+                return path
+        return None
+
+    # get the disk space used by the download directory, counting every running
+    # download as at least expectedSize bytes
+    def getDiskUsage(self):
+        sizes = {videoId: 0 for videoId in self.runningVideoIds}
+        if os.path.isdir(self.downloadDir):
+            for entry in os.scandir(self.downloadDir):
+                if entry.is_file():
+                    videoId = entry.name.split('.', 1)[0]
+                    sizes[videoId] = sizes.get(videoId, 0) + entry.stat().st_size
+        return sum([max(size, self.expectedSize) if videoId in self.runningVideoIds
+            else size for videoId, size in sizes.items()])
+
+    # reserve disk space for a job; returns whether it fits in the disk budget
+    def reserveDiskSpace(self, job):
+        with self.lock:
+            if self.diskBudget is not None and \
+                    self.getDiskUsage() + self.expectedSize > self.diskBudget:
+                return False
+            self.runningVideoIds.add(job.videoId)
+            return True
+
+    def runJob(self, job):
+        if self.stopEvent.is_set():
+            job.state = 'cancelled'
+            return
+        if not self.reserveDiskSpace(job):
+            job.state = 'over disk budget'
+            return
+        try:
+            self.downloadJob(job)
+        finally:
+            with self.lock:
+                self.runningVideoIds.discard(job.videoId)
+
+    def downloadJob(self, job):
+        os.makedirs(self.downloadDir, exist_ok=True)
+        job.state = 'downloading'
+        auth = None
+        if self.useTor and self.circuitManager is not None:
+            auth = self.circuitManager.getAuth()
+        outputTemplate = os.path.join(self.downloadDir, f"{job.videoId}.%(ext)s")
+        def onProgress(progress):
+            job.progress = progress
+        try:
+            self.downloader(job.url, outputTemplate, self.rateLimit, auth, onProgress,
+                    self.stopEvent)
+        except Exception:
+            job.state = 'cancelled' if self.stopEvent.is_set() else 'failed'
+            return
+        if self.getLocalFile(job.url) is None:
+            job.state = 'failed'
+            return
+        job.progress = 1.0
+        job.state = 'done'
+
+    # cancel queued downloads and stop running ones, waiting for their workers to exit
+    def shutdown(self):
+        self.stopEvent.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+"""
+functions
+"""
+
+# use this function to get the video id from a YouTube video url
+def getVideoIdFromUrl(url):
+    match = re.search(r'[?&]v=([\w-]{11})', url)
+    if match is None:
+        return None
+    return match.group(1)
+
+# use this function to check if a file in the download directory is an unfinished
+# download
+def isPartialFile(path):
+    return path.endswith('.part') or path.endswith('.ytdl') or \
+            re.search(r'\.(f[0-9]+|temp)\.[^.]+$', path) is not None
+
+# use this function to download a YouTube video using youtube-dl
+def downloadWithYoutubeDl(url, outputTemplate, rateLimit=None, auth=None,
+        onProgress=None, stopEvent=None, maxResolution=constants.DEFAULT_MAX_RESOLUTION):
+    command = connection_management.getTorsocksCommand(auth) if auth is not None else []
+    command += ['youtube-dl', '--newline', '--continue', '--no-playlist', '--format',
+            f'bestvideo[height=?{maxResolution}]+bestaudio/best', '--output',
+            outputTemplate]
+    if rateLimit is not None:
+        command += ['--limit-rate', str(rateLimit)]
+    command.append(url)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True)
+    if stopEvent is not None:
+        threading.Thread(target=terminateOnStop, args=(process, stopEvent),
+                daemon=True).start()
+    for line in process.stdout:
+        match = re.search(r'\[download\]\s+([0-9.]+)%', line)
+        if match is not None and onProgress is not None:
+            onProgress(float(match.group(1))/100)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+# use this function to terminate a process once stopEvent is set, killing it if it
+# doesn't exit in time
+def terminateOnStop(process, stopEvent, pollInterval=0.5, timeout=5):
+    while process.poll() is None:
+        if stopEvent.wait(pollInterval):
+            process.terminate()
+            try:
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            return
@@ -0,0 +1,115 @@
+import csv
+import io
+import asyncio
+import xml.etree.ElementTree as ElementTree
+import connection_management
+import database_management
+
+# names of the columns a CSV header row may give the channel reference in, in order of
+# preference
+CSV_REFERENCE_COLUMNS = ['channel id', 'channel', 'url', 'reference', 'channel url']
+
+"""
+Reading subscription files
+"""
+
+# use this function to get a list of (channel reference, title) tuples from an OPML
+# string (as exported by e.g. YouTube or other feed readers)
+def parseOpmlContent(content):
+    root = ElementTree.fromstring(content)
+    references = []
+    for outline in root.iter('outline'):
+        reference = outline.get('xmlUrl') or outline.get('htmlUrl')
+        if reference is None:
+            continue
+        title = outline.get('title') or outline.get('text')
+        references.append((reference, title))
+    return references
+
+# use this function to get a list of (channel reference, title) tuples from a CSV string.
+# If there is a header row, the columns are found by their names (as in YouTube's own
+# export, which has the columns Channel Id, Channel Url and Channel Title). Otherwise,
+# the first column holds a channel id, URL or handle, and the optional second column
+# holds the channel title
+def parseCsvContent(content):
+    references = []
+    referenceColumn, titleColumn = 0, 1
+    for row in csv.reader(io.StringIO(content)):
+        if not row or not row[0].strip():
+            continue
+        names = [name.strip().lower() for name in row]
+        if not references and names[0] in CSV_REFERENCE_COLUMNS:
+            referenceColumn = [names.index(name) for name in CSV_REFERENCE_COLUMNS
+                if name in names][0]
+            titleColumn = names.index('title') if 'title' in names else \
+                    names.index('channel title') if 'channel title' in names else None
+            continue
+        reference = row[referenceColumn].strip() if len(row) > referenceColumn else ''
+        if not reference:
+            continue
+        title = row[titleColumn].strip() if titleColumn is not None and \
+                len(row) > titleColumn and row[titleColumn].strip() else None
+        references.append((reference, title))
+    return references
+
+# use this function to read channel references from an OPML or CSV file (based on the
+# file extension)
+def parseSubscriptionFile(filename):
+    with open(filename, 'r') as filePointer:
+        content = filePointer.read()
+    if filename.lower().endswith('.csv'):
+        return parseCsvContent(content)
+    return parseOpmlContent(content)
+
+"""
+Writing subscription files
+"""
+
+# use this function to get an OPML representation of the subscriptions in a database
+def getOpmlString(database):
+    opml = ElementTree.Element('opml', version='1.1')
+    ElementTree.SubElement(ElementTree.SubElement(opml, 'head'), 'title').text = \
+            'YouTube_RSS subscriptions'
+    outlineRoot = ElementTree.SubElement(ElementTree.SubElement(opml, 'body'), 'outline',
+            text='YouTube Subscriptions', title='YouTube Subscriptions')
+    for channelId, channelTitle in database['id to title'].items():
+        ElementTree.SubElement(outlineRoot, 'outline', text=channelTitle,
+                title=channelTitle, type='rss',
+                xmlUrl=connection_management.getRssAddressFromChannelId(channelId))
+    return ElementTree.tostring(opml, encoding='unicode')
+
+# use this function to get a CSV representation of the subscriptions in a database
+def getCsvString(database):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['channel id', 'title'])
+    for channelId, channelTitle in database['id to title'].items():
+        writer.writerow([channelId, channelTitle])
+    return output.getvalue()
+
+# use this function to write the subscriptions in a database to an OPML or CSV file
+# (based on the file extension)
+def exportSubscriptionsToFile(database, filename):
+    if filename.lower().endswith('.csv'):
+        content = getCsvString(database)
+    else:
+        content = getOpmlString(database)
+    with open(filename, 'w') as filePointer:
+        filePointer.write(content)
+
+"""
+Importing
+"""
+
+# use this function to import the channels in an OPML or CSV file. References are
+# resolved concurrently and all channels are added with a single database write, with
+# an optional single batched refresh. Returns the added channel ids and the references
+# that could not be resolved
+def importSubscriptionsFromFile(filename, refresh=False, useTor=False,
+        circuitManager=None):
+    references = parseSubscriptionFile(filename)
+    resolved, unresolved = asyncio.run(connection_management.resolveChannelReferences(
+            references, useTor=useTor, circuitManager=circuitManager))
+    addedChannelIds = database_management.addSubscriptionsToDatabase(resolved,
+            refresh=refresh, useTor=useTor, circuitManager=circuitManager)
+    return addedChannelIds, unresolved
@@ -1,4 +1,5 @@
 import constants
+import profiling
 import presentation
 import indicator_classes
 import database_management
@@ -18,7 +19,11 @@ class MethodMenuDecision:
         return str(self.description)
 
     def executeDecision(self):
-        return self.function(*self.args, **self.kwargs)
+        if self.function is doReturnFromMenu:
+            # nothing worth profiling happens when going back
+            return self.function(*self.args, **self.kwargs)
+        return profiling.runFlow(profiling.getFlowName(self.function), self.function,
+                *self.args, **self.kwargs)
 
 class FeedVideoDescriber:
     def __init__(self, video):
@@ -43,6 +48,52 @@ class FeedDescriber:
         return ''.join([self.channelTitle, ': (', str(sum([1 for video in self.feed
             if not video['seen']])),'/',str(len(self.feed)), ')'])
 
+# menu options whose decisions are only built for the rows that are shown or chosen, so
+# that opening a menu doesn't take longer the more items it has. The first rows are the
+# decisions in header, followed by one row per item, built by getDecision(item)
+class LazyMenuOptions:
+    def __init__(self, items, getDecision, header=[]):
+        self.items = items
+        self.getDecision = getDecision
+        self.header = list(header)
+        self.decisions = {}
+        self.menuWidths = {}
+
+    # the rows of the menu that show items rather than the header
+    def getItemRows(self):
+        return range(len(self.header), len(self))
+
+    def getItem(self, index):
+        return self.items[index - len(self.header)]
+
+    # the width of the widest row, computed once over all rows (without keeping the
+    # decisions built for it)
+    def getMenuWidth(self, showItemNumber=True):
+        if showItemNumber not in self.menuWidths:
+            self.menuWidths[showItemNumber] = max([len(presentation.getItemString(
+                index, self.getRowDecision(index), showItemNumber))
+                for index in range(len(self))], default=0)
+        return self.menuWidths[showItemNumber]
+
+    def getRowDecision(self, index):
+        if index < len(self.header):
+            return self.header[index]
+        if index in self.decisions:
+            return self.decisions[index]
+        return self.getDecision(self.getItem(index))
+
+    def __len__(self):
+        return len(self.header) + len(self.items)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        if index >= len(self.header) and index not in self.decisions:
+            self.decisions[index] = self.getRowDecision(index)
+        return self.getRowDecision(index)
+
 class AdHocKey:
     def __init__(self, key, item, activationIndex = constants.ANY_INDEX):
         self.key = key
@@ -58,13 +109,13 @@ class AdHocKey:
     def __eq__(self,other):
         if isinstance(other, int):
             return other == self.key
-        if isinstance(other, chr):
+        if isinstance(other, str):
             return other == chr(self.key)
         if isinstance(other, AdHocKey):
             return other.key == self.key and other.item == self.item and \
                     other.activationIndex == self.activationIndex
         else:
-            raise TypeError
+            return NotImplemented
 
 class MarkAllAsReadKey(AdHocKey):
     def __init__(self, channelId, activationIndex, database, key=ord('a')):
@@ -85,6 +136,15 @@ class MarkEntryAsReadKey(AdHocKey):
                 )
         AdHocKey.__init__(self, key=key, item=item, activationIndex=activationIndex)
 
+class DownloadEntryKey(AdHocKey):
+    def __init__(self, video, activationIndex, downloadManager, key=ord('d')):
+        item =  MethodMenuDecision(
+                    "download video",
+                    downloadManager.queue,
+                    [video]
+                )
+        AdHocKey.__init__(self, key=key, item=item, activationIndex=activationIndex)
+
 """
 functions
 """
@@ -127,4 +187,4 @@ def doMarkChannelAsRead(database, channelId):
             break
     for video in database['feeds'][channelId]:
         video['seen'] = not allAreAlreadyMarkedAsRead
-    database_management.outputDatabaseToFile(database, constants.DATABASE_PATH)
+    database_management.saveDatabase(database)
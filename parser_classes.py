@@ -11,11 +11,14 @@ class RssAddressParser(HTMLParser):
     def __init__(self):
         super(RssAddressParser, self).__init__(convert_charrefs=True)
         self.rssAddress = None
+        self.channelTitle = None
 
     def handle_starttag(self, tag, attrs):
         attrDict = dict(attrs)
         if 'type' in attrDict and attrDict['type'] == 'application/rss+xml':
             self.rssAddress = attrDict['href']
+        elif tag == 'meta' and attrDict.get('property') == 'og:title':
+            self.channelTitle = attrDict.get('content')
 
 # Parser used for extracting information about channels from YouTube channel query HTML
 class ChannelQueryParser(HTMLParser):
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import socket
+import threading
+import subprocess
+import constants
+import connection_management
+
+"""
+classes
+"""
+
+# keeps a single mpv instance running and drives it over its JSON IPC socket, so that
+# the cost of starting the player is only paid once, and so that several videos can be
+# queued up. onFinished is called with the url of every file that is played to its end.
+# launchCommand is called as launchCommand(socketPath) and should start something that
+# serves mpv's IPC protocol on socketPath (by default, mpv itself)
+class MpvController:
+    def __init__(self, useTor=False, circuitManager=None,
+            maxResolution=constants.DEFAULT_MAX_RESOLUTION,
+            socketPath=constants.MPV_SOCKET_PATH, onFinished=None, launchCommand=None,
+            connectTimeout=10):
+        self.useTor = useTor
+        self.circuitManager = circuitManager
+        self.maxResolution = maxResolution
+        self.socketPath = socketPath
+        self.onFinished = onFinished
+        self.launchCommand = launchCommand if launchCommand is not None \
+                else self.launchMpv
+        self.connectTimeout = connectTimeout
+        self.process = None
+        self.sock = None
+        self.readerThread = None
+        self.writeLock = threading.Lock()
+        self.requestId = 0
+        self.currentPath = None
+
+    # start the player (if it isn't already running) and connect to its IPC socket
+    def start(self):
+        if self.isRunning():
+            return
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        self.process = self.launchCommand(self.socketPath)
+        deadline = time.time() + self.connectTimeout
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(self.socketPath)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                self.sock = None
+                if time.time() > deadline:
+                    raise PlayerNotReachable(f"no IPC server at {self.socketPath}")
+                time.sleep(0.05)
+        self.currentPath = None
+        self.readerThread = threading.Thread(target=self.readEvents, daemon=True)
+        self.readerThread.start()
+        self.sendCommand(['observe_property', 1, 'path'])
+
+    # this is the default launch command, which starts an idle mpv listening on the
+    # IPC socket
+    def launchMpv(self, socketPath):
+        command = []
+        if self.useTor:
+            command += connection_management.getTorsocksCommand(
+                    self.circuitManager.getAuth())
+        command += ['mpv', '--idle=yes', '--force-window=yes',
+                f'--input-ipc-server={socketPath}',
+                f'--ytdl-format=bestvideo[height=?{self.maxResolution}]+bestaudio/best']
+        return subprocess.Popen(command, stdout = subprocess.DEVNULL,
+                stderr = subprocess.STDOUT)
+
+    def isRunning(self):
+        if self.sock is None:
+            return False
+        return self.process is None or self.process.poll() is None
+
+    def sendCommand(self, command):
+        with self.writeLock:
+            self.requestId += 1
+            message = {'command': command, 'request_id': self.requestId}
+            self.sock.sendall((json.dumps(message) + '\n').encode())
+
+    # play a url right away, replacing whatever is currently playing
+    def play(self, url):
+        self.start()
+        self.sendCommand(['loadfile', url, 'replace'])
+
+    # add urls to the end of the playlist, starting playback if the player is idle
+    def queue(self, urls):
+        self.start()
+        for url in urls:
+            self.sendCommand(['loadfile', url, 'append-play'])
+
+    def quit(self):
+        if self.isRunning():
+            try:
+                self.sendCommand(['quit'])
+            except OSError:
+                pass
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=self.connectTimeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    # this runs in a background thread, keeping track of the currently playing file and
+    # reporting files that have been played to their end
+    def readEvents(self):
+        buffer = b''
+        sock = self.sock
+        while True:
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                self.handleEvent(message)
+
+    def handleEvent(self, message):
+        event = message.get('event')
+        if event == 'property-change' and message.get('name') == 'path':
+            if message.get('data') is not None:
+                self.currentPath = message.get('data')
+        elif event == 'end-file' and message.get('reason') == 'eof':
+            if self.currentPath is not None and self.onFinished is not None:
+                self.onFinished(self.currentPath)
+
+"""
+Exception classes
+"""
+
+# indicates that the player's IPC socket could not be connected to
+class PlayerNotReachable(Exception):
+    pass
@@ -1,31 +1,189 @@
+import time
 import curses
 import inspect
+import collections
+import constants
+import profiling
 import indicator_classes
 import asyncio
 
 HIGHLIGHTED = 1
 NOT_HIGHLIGHTED = 2
 
+"""
+classes
+"""
+
+# table of ad hoc keys indexed by (key, row), so that finding the ad hoc key pressed on a
+# row takes constant time, however many rows a menu has. Ad hoc keys bound to a range of
+# rows (such as "mark as read" on every entry of a feed) are only built once pressed, by
+# getAdHocKey(row)
+class AdHocKeyTable:
+    def __init__(self, adHocKeys=[]):
+        self.adHocKeys = {}
+        self.rowBindings = {}
+        self.boundKeys = set()
+        for adHocKey in adHocKeys:
+            self.add(adHocKey)
+
+    def add(self, adHocKey):
+        # the first ad hoc key added for a (key, row) takes precedence
+        self.adHocKeys.setdefault((adHocKey.key, adHocKey.activationIndex), adHocKey)
+        self.boundKeys.add(adHocKey.key)
+
+    def addForRows(self, key, getAdHocKey, rows):
+        self.rowBindings.setdefault(key, []).append((rows, getAdHocKey))
+        self.boundKeys.add(key)
+
+    def getAdHocKey(self, key, index):
+        for activationIndex in [index, constants.ANY_INDEX]:
+            if (key, activationIndex) in self.adHocKeys:
+                return self.adHocKeys[(key, activationIndex)]
+        for rows, getAdHocKey in self.rowBindings.get(key, []):
+            if index in rows:
+                return getAdHocKey(index)
+        return None
+
+    def __contains__(self, key):
+        return key in self.boundKeys
+
+# renders on the terminal, through curses
+class CursesBackend:
+    def run(self, function, *args, **kwargs):
+        return curses.wrapper(function, *args, **kwargs)
+
+    def initScreen(self, stdscr):
+        curses.curs_set(0)
+        curses.init_pair(HIGHLIGHTED, curses.COLOR_BLACK, curses.COLOR_WHITE)
+        curses.init_pair(NOT_HIGHLIGHTED, curses.COLOR_WHITE, curses.COLOR_BLACK)
+
+    def getColorAttribute(self, colorPair):
+        return curses.color_pair(colorPair)
+
+# renders on a VirtualScreen instead of the terminal, so that the user interface can be
+# run headless, e.g. for benchmarking it
+class VirtualBackend:
+    def __init__(self, screen):
+        self.screen = screen
+
+    def run(self, function, *args, **kwargs):
+        self.screen.open()
+        return function(self.screen, *args, **kwargs)
+
+    def initScreen(self, stdscr):
+        pass
+
+    def getColorAttribute(self, colorPair):
+        return colorPair
+
+# in-memory stand-in for a curses window. Keypresses are read from a script of keys, and
+# for every keypress, the time until the next key is read (i.e. the time spent handling
+# the keypress and rendering the result) and the number of cells written are recorded.
+# Likewise, for every query run on the screen, the time until its first key is read (i.e.
+# the time spent opening it) and the number of cells written are recorded in opens
+class VirtualScreen:
+    def __init__(self, height=24, width=80, keys=[]):
+        self.height = height
+        self.width = width
+        self.keys = collections.deque(keys)
+        self.attribute = 0
+        self.cellsWritten = 0
+        self.keystrokes = []
+        self.opens = []
+        self.lastKeyTime = None
+        self.lastCellsWritten = 0
+        self.openTime = None
+        self.clear()
+
+    # called when a query starts running on the screen
+    def open(self):
+        self.openTime = time.perf_counter()
+        self.lastKeyTime = None
+        self.lastCellsWritten = self.cellsWritten
+
+    # cells are kept sparsely, as a dict from (y, x) to (character, attribute), so that
+    # the cost of the virtual screen itself doesn't dominate the measurements
+    def clear(self):
+        self.cells = {}
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    # like curses, text wraps onto the next line, and writing outside the screen is an
+    # error
+    def addstr(self, y, x, string):
+        if y < 0 or y >= self.height or x < 0 or x >= self.width:
+            raise curses.error(f"addstr() outside the screen: {y}, {x}")
+        for char in string:
+            if y >= self.height:
+                raise curses.error("addstr() past the end of the screen")
+            self.cells[(y, x)] = (char, self.attribute)
+            self.cellsWritten += 1
+            x += 1
+            if x == self.width:
+                x = 0
+                y += 1
+
+    def attron(self, attribute):
+        self.attribute = attribute
+
+    def attroff(self, attribute):
+        self.attribute = 0
+
+    def refresh(self):
+        pass
+
+    def getch(self):
+        now = time.perf_counter()
+        if self.openTime is not None:
+            self.opens.append((now - self.openTime,
+                self.cellsWritten - self.lastCellsWritten))
+            self.openTime = None
+        elif self.lastKeyTime is not None:
+            self.keystrokes.append((now - self.lastKeyTime,
+                self.cellsWritten - self.lastCellsWritten))
+        if not self.keys:
+            raise OutOfKeys
+        key = self.keys.popleft()
+        self.lastCellsWritten = self.cellsWritten
+        self.lastKeyTime = time.perf_counter()
+        return key
+
+    def getLines(self):
+        return [''.join([self.cells.get((y, x), (' ', 0))[0] for x in range(self.width)])
+                for y in range(self.height)]
+
+renderBackend = CursesBackend()
+
+"""
+functions
+"""
+
+# use this function to render the user interface through another backend, such as a
+# VirtualBackend
+def useRenderBackend(backend):
+    global renderBackend
+    renderBackend = backend
+
 
 # This function displays a message while the user waits for a function to execute
 def doWaitScreen(message, cb, *args, **kwargs):
-    return curses.wrapper(doWaitScreenNcurses, message, cb, *args, **kwargs)
+    return renderBackend.run(doWaitScreenNcurses, message, cb, *args, **kwargs)
 
 # This function is where the Ncurses level of doWaitScreen starts.
 # It should never be called directly, but always through doWaitScreen!
 def doWaitScreenNcurses(stdscr, message, cb, *args, **kwargs):
-    curses.curs_set(0)
-    curses.init_pair(HIGHLIGHTED, curses.COLOR_BLACK, curses.COLOR_WHITE)
-    curses.init_pair(NOT_HIGHLIGHTED, curses.COLOR_WHITE, curses.COLOR_BLACK)
+    renderBackend.initScreen(stdscr)
     printMenu(message, [], stdscr, 0, showItemNumber=False)
     if inspect.iscoroutinefunction(cb):
-        return asyncio.run(cb(*args, **kwargs))
+        return profiling.runFlow(profiling.getFlowName(cb), asyncio.run,
+                cb(*args, **kwargs))
     else:
-        return cb(*args, **kwargs)
+        return profiling.runFlow(profiling.getFlowName(cb), cb, *args, **kwargs)
 
 # This Function gets a yes/no response to some query from the user
 def doYesNoQuery(query):
-    return curses.wrapper(doYnQueryNcurses, query)
+    return renderBackend.run(doYnQueryNcurses, query)
 
 # This function is where the Ncurses level of doYesNoQuery starts.
 # It should never be called directly, but always through doYesNoQuery!
@@ -36,7 +194,7 @@ def doYnQueryNcurses(stdscr, query):
 # This function lets the user choose an object from a list
 def doSelectionQuery(query, options, queryStyle=indicator_classes.ItemQuery, 
         initialIndex=None, showItemNumber=True, adHocKeys=[]):
-    return curses.wrapper(doSelectionQueryNcurses, query, options,
+    return renderBackend.run(doSelectionQueryNcurses, query, options,
             queryStyle=queryStyle, initialIndex=initialIndex,
             showItemNumber=showItemNumber, adHocKeys=adHocKeys)
 
@@ -45,9 +203,9 @@ def doSelectionQuery(query, options, queryStyle=indicator_classes.ItemQuery,
 def doSelectionQueryNcurses(stdscr, query, options, 
         queryStyle=indicator_classes.ItemQuery, initialIndex=None, showItemNumber=True, 
         adHocKeys=[]):
-    curses.curs_set(0)
-    curses.init_pair(HIGHLIGHTED, curses.COLOR_BLACK, curses.COLOR_WHITE)
-    curses.init_pair(NOT_HIGHLIGHTED, curses.COLOR_WHITE, curses.COLOR_BLACK)
+    renderBackend.initScreen(stdscr)
+    if not isinstance(adHocKeys, AdHocKeyTable):
+        adHocKeys = AdHocKeyTable(adHocKeys)
     jumpNumList = []
     if initialIndex is not None:
         choiceIndex = initialIndex
@@ -56,18 +214,19 @@ def doSelectionQueryNcurses(stdscr, query, options,
     while True:
         printMenu(query, options, stdscr, choiceIndex, showItemNumber=showItemNumber,
                 jumpNumStr = ''.join(jumpNumList))
-        key = stdscr.getch()
+        key = profiling.waitForInput(stdscr.getch)
         # Ad hoc keys should always take first precedence
 
         if key in adHocKeys:
-            for adHocKey in adHocKeys:
-                if adHocKey.isValidIndex(choiceIndex):
-                    if queryStyle is indicator_classes.ItemQuery:
-                        return adHocKey.item
-                    elif queryStyle is indicator_classes.IndexQuery:
-                        return choiceIndex
-                    elif queryStyle is indicator_classes.CombinedQuery:
-                        return adHocKey.item, choiceIndex
+            adHocKey = adHocKeys.getAdHocKey(key, choiceIndex)
+            if adHocKey is None:
+                pass
+            elif queryStyle is indicator_classes.ItemQuery:
+                return adHocKey.item
+            elif queryStyle is indicator_classes.IndexQuery:
+                return choiceIndex
+            elif queryStyle is indicator_classes.CombinedQuery:
+                return adHocKey.item, choiceIndex
 
         elif key in [curses.KEY_UP, ord('k')]:
             jumpNumList = []
@@ -111,22 +270,19 @@ def doNotify(message):
 
 # This function gets a string of written input from the user
 def doGetUserInput(query, maxInputLength=40):
-    return curses.wrapper(doGetUserInputNcurses, query, maxInputLength=maxInputLength)
+    return renderBackend.run(doGetUserInputNcurses, query, maxInputLength=maxInputLength)
 
 # This function is where the Ncurses level of doGetUserInput starts.
 # It should never be called directly, but always through doGetUserInput!
 def doGetUserInputNcurses(stdscr, query, maxInputLength=40):
-    curses.curs_set(0)
-    curses.init_pair(HIGHLIGHTED, curses.COLOR_BLACK, curses.COLOR_WHITE)
-    curses.init_pair(NOT_HIGHLIGHTED, curses.COLOR_WHITE, curses.COLOR_BLACK)
-    curses.curs_set(0)
+    renderBackend.initScreen(stdscr)
     curserPosition = 0
     userInputChars = []
     while True:
         printMenu(query, [''.join(userInputChars), ''.join(['—' if i==curserPosition else
             ' ' for i in range(maxInputLength)])], stdscr, 0,
                 xAlignment=maxInputLength//2, showItemNumber=False)
-        key = stdscr.getch()
+        key = profiling.waitForInput(stdscr.getch)
         if key in [curses.KEY_BACKSPACE, ord('\b'), ord('\x7f')]:
             deleteIndex = curserPosition-1
             if deleteIndex >= 0 : userInputChars.pop(curserPosition-1)
@@ -146,6 +302,19 @@ def doGetUserInputNcurses(stdscr, query, maxInputLength=40):
             userInputChars.insert(curserPosition,chr(key))
             curserPosition = min(maxInputLength, curserPosition+1)
 
+# use this function to get the string a menu item is printed as
+def getItemString(index, item, showItemNumber=True):
+    return f"{index+1}: {item}" if showItemNumber else str(item)
+
+# use this function to get the width of the widest item of a menu. Menus that can
+# compute it more cheaply (such as method_menu.LazyMenuOptions, which computes it once)
+# provide a getMenuWidth method
+def getMenuWidth(menu, showItemNumber=True):
+    if hasattr(menu, 'getMenuWidth'):
+        return menu.getMenuWidth(showItemNumber)
+    return max([len(getItemString(i, item, showItemNumber))
+        for i, item in enumerate(menu)], default=0)
+
 # This function is used to visually represent a query and a number of menu items to the 
 # user, by using nCurses. It is used for all text printing in the program (even where
 # no application level menu is presented, i.e by simply not providing a query and no
@@ -158,12 +327,28 @@ def printMenu(query, menu, stdscr, choiceIndex, xAlignment=None, showItemNumber=
     screenCenterY = height//2
     nRowsToPrint = (len(menu)+2)
 
+    offset = 0
+    titleY = screenCenterY-nRowsToPrint//2
+    if nRowsToPrint >= height-2:
+        yTitleTheoretical = screenCenterY - nRowsToPrint//2
+        ySelectedTheoretical = (yTitleTheoretical + 2 + choiceIndex)
+        yLastTheoretical = yTitleTheoretical + nRowsToPrint-1
+        offset = min(max(ySelectedTheoretical-screenCenterY, yTitleTheoretical), 
+                yLastTheoretical - (height-2))
+    titleY -= offset
+
+    # only the items that fit on the screen are looked at, so that the cost of printing
+    # doesn't grow with the length of the menu
+    firstItemY = titleY + 2
+    visibleItems = [(i, menu[i]) for i in range(max(-firstItemY, 0),
+        min(len(menu), height-1-firstItemY))]
+
     if xAlignment is not None:
         itemX = max(min(screenCenterX - xAlignment, width-2),0)
-    elif menu:
-        menuWidth = max([len(f"{i+1}: {item}" if showItemNumber else str(item)) for i, 
-            item in enumerate(menu)])
-        itemX = max(screenCenterX - menuWidth//2, 0)
+    elif visibleItems:
+        # the width is taken over all items, so that the menu doesn't move sideways
+        # while scrolling
+        itemX = max(screenCenterX - getMenuWidth(menu, showItemNumber)//2, 0)
     else:
         itemX = None
     
@@ -174,16 +359,6 @@ def printMenu(query, menu, stdscr, choiceIndex, xAlignment=None, showItemNumber=
     if jumpNumStr:
         stdscr.addstr(0,0,jumpNumStr)
 
-    offset = 0
-    titleY = screenCenterY-nRowsToPrint//2
-    if nRowsToPrint >= height-2:
-        yTitleTheoretical = screenCenterY - nRowsToPrint//2
-        ySelectedTheoretical = (yTitleTheoretical + 2 + choiceIndex)
-        yLastTheoretical = yTitleTheoretical + nRowsToPrint-1
-        offset = min(max(ySelectedTheoretical-screenCenterY, yTitleTheoretical), 
-                yLastTheoretical - (height-2))
-    titleY -= offset
-
     titleX = max(screenCenterX-(len(query)//2),0)
     if titleX != 0:
         titleX = max(min(abs(titleX), width)*(titleX//abs(titleX)),0)
@@ -191,14 +366,14 @@ def printMenu(query, menu, stdscr, choiceIndex, xAlignment=None, showItemNumber=
         query = query[0:width-1]
     if titleY >= 0 and titleY<height-1:
         stdscr.addstr(titleY, titleX, query)
-    for i, item in enumerate(menu):
-        itemString = f"{i+1}: {item}" if showItemNumber else str(item)
+    for i, item in visibleItems:
+        itemString = getItemString(i, item, showItemNumber)
         if itemX + len(itemString) >= width-1:
             itemString = itemString[:max((width-itemX-2),0)]
-        attr = curses.color_pair(HIGHLIGHTED if i == choiceIndex else NOT_HIGHLIGHTED)
+        attr = renderBackend.getColorAttribute(HIGHLIGHTED if i == choiceIndex else NOT_HIGHLIGHTED)
         stdscr.attron(attr)
-        itemY = screenCenterY - nRowsToPrint//2 + i + 2 - offset
-        if itemY >= 0 and itemY < height-1 and itemString:
+        itemY = firstItemY + i
+        if itemString:
             stdscr.addstr(itemY, itemX, itemString)
         stdscr.attroff(attr)
     stdscr.refresh()
@@ -210,3 +385,7 @@ Exception classes
 # indicates that the provided query style is not supported
 class UnknownQueryStyle(Exception):
     pass
+
+# indicates that a VirtualScreen has run out of scripted keys
+class OutOfKeys(Exception):
+    pass
@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+import constants
+
+# Profiling of application level flows, enabled with --profile. Every flow run through
+# runFlow (every MethodMenuDecision and every doWaitScreen callback) gets a cProfile
+# profile (<name>.prof) and a summary (<name>.json) with its wall time, CPU time, peak
+# memory, and top functions and allocation sites written to the profile directory.
+# Flows are nested (a menu flow runs the flows chosen in its menu), so the profiling of a
+# flow is paused while a flow it started runs, and each profile only covers the time
+# spent in the flow itself. Likewise, profiling is paused while the user interface waits
+# for input (see waitForInput), so that a menu left open doesn't look slow; the time
+# spent waiting is reported separately as input wait time. Only flows that take at least minWallTime get their profile written,
+# so that trivial flows (such as going back from a menu) don't flood the profile
+# directory
+
+profiler = None
+
+"""
+classes
+"""
+
+# profiling state of one running flow
+class FlowProfile:
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.wallTime = 0
+        self.cpuTime = 0
+        self.peakMemory = 0
+        self.inputWaitTime = 0
+        self.snapshot = tracemalloc.take_snapshot()
+
+    def resume(self):
+        tracemalloc.reset_peak()
+        self.resumeWallTime = time.perf_counter()
+        self.resumeCpuTime = time.process_time()
+        self.profile.enable()
+
+    def pause(self):
+        self.profile.disable()
+        self.wallTime += time.perf_counter() - self.resumeWallTime
+        self.cpuTime += time.process_time() - self.resumeCpuTime
+        self.peakMemory = max(self.peakMemory, tracemalloc.get_traced_memory()[1])
+
+class FlowProfiler:
+    def __init__(self, profileDir=constants.PROFILE_DIR, nTopEntries=15,
+            minWallTime=constants.PROFILE_MIN_WALL_TIME):
+        self.profileDir = profileDir
+        self.nTopEntries = nTopEntries
+        self.minWallTime = minWallTime
+        self.runningFlows = []
+        self.nFlows = 0
+        os.makedirs(profileDir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def runFlow(self, name, function, *args, **kwargs):
+        if self.runningFlows:
+            self.runningFlows[-1].pause()
+        flowProfile = FlowProfile(name)
+        self.runningFlows.append(flowProfile)
+        flowProfile.resume()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            flowProfile.pause()
+            self.runningFlows.pop()
+            if flowProfile.wallTime >= self.minWallTime:
+                self.writeProfile(flowProfile)
+            if self.runningFlows:
+                self.runningFlows[-1].resume()
+
+    # run function (which waits for user input) with the profiling of the running flow
+    # paused
+    def waitForInput(self, function, *args, **kwargs):
+        if not self.runningFlows:
+            return function(*args, **kwargs)
+        flowProfile = self.runningFlows[-1]
+        flowProfile.pause()
+        startTime = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            flowProfile.inputWaitTime += time.perf_counter() - startTime
+            flowProfile.resume()
+
+    def writeProfile(self, flowProfile):
+        self.nFlows += 1
+        fileName = '-'.join([time.strftime('%Y%m%d-%H%M%S'), f"{os.getpid()}",
+            f"{self.nFlows:04d}", re.sub(r'[^\w.-]', '_', flowProfile.name)])
+        path = os.path.join(self.profileDir, fileName)
+        flowProfile.profile.dump_stats(path + '.prof')
+        allocationStats = tracemalloc.take_snapshot().compare_to(flowProfile.snapshot,
+                'lineno')
+        summary = {
+            'flow': flowProfile.name,
+            'time': time.time(),
+            'wall time': flowProfile.wallTime,
+            'cpu time': flowProfile.cpuTime,
+            'input wait time': flowProfile.inputWaitTime,
+            'peak memory': flowProfile.peakMemory,
+            'top functions': getTopFunctions(flowProfile.profile, self.nTopEntries),
+            'top allocations': [{'site': str(stat.traceback), 'size': stat.size_diff,
+                'count': stat.count_diff} for stat in allocationStats[:self.nTopEntries]]
+        }
+        with open(path + '.json', 'w') as filePointer:
+            json.dump(summary, filePointer, indent=1)
+
+"""
+functions
+"""
+
+# use this function to enable profiling of flows
+def useProfiler(flowProfiler):
+    global profiler
+    profiler = flowProfiler
+
+# use this function to run an application level flow, profiling it if profiling is
+# enabled
+def runFlow(name, function, *args, **kwargs):
+    if profiler is None:
+        return function(*args, **kwargs)
+    return profiler.runFlow(name, function, *args, **kwargs)
+
+# use this function to wait for user input (by calling function), without counting the
+# time spent waiting towards the running flow
+def waitForInput(function, *args, **kwargs):
+    if profiler is None:
+        return function(*args, **kwargs)
+    return profiler.waitForInput(function, *args, **kwargs)
+
+# use this function to get the name of the flow a function runs
+def getFlowName(function):
+    return getattr(function, '__qualname__', None) or repr(function)
+
+def getTopFunctions(profile, nEntries):
+    stats = pstats.Stats(profile)
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    return [{'function': f"{fileName}:{lineNumber}({functionName})", 'calls': calls,
+        'total time': totalTime, 'cumulative time': cumulativeTime}
+        for (fileName, lineNumber, functionName), (_, calls, totalTime, cumulativeTime, _)
+        in entries[:nEntries]]
+
+# use this function to rank the profiled flows (summed over all their runs) by total
+# wall time, or by peak memory
+def getProfileSummary(profileDir=constants.PROFILE_DIR, orderBy='wall time'):
+    flows = {}
+    for fileName in sorted(os.listdir(profileDir)):
+        if not fileName.endswith('.json'):
+            continue
+        with open(os.path.join(profileDir, fileName), 'r') as filePointer:
+            summary = json.load(filePointer)
+        flow = flows.setdefault(summary['flow'], {'flow': summary['flow'], 'runs': 0,
+            'wall time': 0, 'cpu time': 0, 'max wall time': 0, 'peak memory': 0,
+            'slowest profile': None})
+        flow['runs'] += 1
+        flow['wall time'] += summary['wall time']
+        flow['cpu time'] += summary['cpu time']
+        flow['peak memory'] = max(flow['peak memory'], summary['peak memory'])
+        if summary['wall time'] >= flow['max wall time']:
+            flow['max wall time'] = summary['wall time']
+            flow['slowest profile'] = fileName[:-len('.json')] + '.prof'
+    return sorted(flows.values(), key=lambda flow: flow[orderBy], reverse=True)
@@ -0,0 +1,111 @@
+import re
+import time
+import threading
+import subprocess
+import concurrent.futures
+import constants
+import connection_management
+
+"""
+classes
+"""
+
+# resolves the streams of YouTube videos in the background, so that mpv can be handed
+# the resolved streams directly instead of running youtube-dl itself when starting.
+# resolveCommand is called as resolveCommand(url, maxResolution, auth) and should return
+# a list of stream URLs (typically one video and one audio stream). Since the signed
+# stream URLs are tied to the address that resolved them, the socks5 auth used for
+# resolving (None if Tor isn't used) is cached along with the streams, and should be
+# reused when playing them. Streams are prefetched at maxResolution, which should be set
+# to the resolution the user chose last, so that prefetched streams get used
+class StreamResolver:
+    def __init__(self, useTor=False, circuitManager=None, resolveCommand=None,
+            maxWorkers=2, safetyMargin=60,
+            maxResolution=constants.DEFAULT_MAX_RESOLUTION):
+        self.useTor = useTor
+        self.circuitManager = circuitManager
+        self.maxResolution = maxResolution
+        self.resolveCommand = resolveCommand if resolveCommand is not None \
+                else resolveStreamsWithYoutubeDl
+        self.safetyMargin = safetyMargin
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.pending = {}
+
+    # start resolving the streams of the given urls in the background (urls that are
+    # already cached or being resolved are skipped)
+    def prefetch(self, urls, maxResolution=None):
+        if maxResolution is None:
+            maxResolution = self.maxResolution
+        with self.lock:
+            for url in urls:
+                key = (url, maxResolution)
+                if key in self.pending or self._getCachedStreams(key) is not None:
+                    continue
+                self.pending[key] = self.executor.submit(self._resolve, url,
+                        maxResolution)
+
+    # get the resolved streams of a url along with the socks5 auth used for resolving
+    # them, or None if they aren't cached (or have expired)
+    def getResolvedStreams(self, url, maxResolution=constants.DEFAULT_MAX_RESOLUTION):
+        with self.lock:
+            return self._getCachedStreams((url, maxResolution))
+
+    # drop the cached streams of a url, e.g. after they failed to play
+    def evict(self, url, maxResolution=constants.DEFAULT_MAX_RESOLUTION):
+        with self.lock:
+            self.cache.pop((url, maxResolution), None)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _getCachedStreams(self, key):
+        if key not in self.cache:
+            return None
+        streams, auth, expiryTime = self.cache[key]
+        if expiryTime < time.time():
+            self.cache.pop(key)
+            return None
+        return streams, auth
+
+    def _resolve(self, url, maxResolution):
+        key = (url, maxResolution)
+        try:
+            auth = None
+            if self.useTor:
+                auth = self.circuitManager.getAuth()
+            streams = self.resolveCommand(url, maxResolution, auth)
+            if streams:
+                expiryTime = getStreamExpiryTime(streams) - self.safetyMargin
+                with self.lock:
+                    self.cache[key] = (streams, auth, expiryTime)
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+"""
+functions
+"""
+
+# use this function to get the time at which resolved (signed) stream URLs expire
+def getStreamExpiryTime(streams):
+    expiryTimes = []
+    for stream in streams:
+        match = re.search(r'[?&/]expire[=/]([0-9]+)', stream)
+        if match is not None:
+            expiryTimes.append(int(match.group(1)))
+    if expiryTimes:
+        return min(expiryTimes)
+    return time.time() + constants.STREAM_CACHE_TTL
+
+# use this function to resolve the stream URLs of a YouTube video using youtube-dl
+def resolveStreamsWithYoutubeDl(url, maxResolution, auth=None):
+    command = connection_management.getTorsocksCommand(auth) if auth is not None else []
+    command += ['youtube-dl', '--get-url', '--format',
+            f'bestvideo[height=?{maxResolution}]+bestaudio/best', url]
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            text=True, check=True).stdout
+    return [line for line in output.splitlines() if line.strip()]
@@ -0,0 +1,338 @@
+import os
+import re
+import json
+import socket
+import secrets
+import threading
+import socketserver
+import constants
+import database_management
+
+# Delta sync of subscriptions, entries and seen-state between machines.
+#
+# Every synced record (a subscription, an entry or the seen-state of an entry) carries a
+# version stamp [counter, replica id]: counter is a Lamport clock, which is advanced past
+# every stamp received, so a change made after seeing another change always gets the
+# higher stamp. When two machines changed the same record, the change with the higher
+# stamp wins, ties being broken by replica id, so every machine resolves conflicts the
+# same way. Local changes are found by comparing the database with the values of the
+# records as last synced, and get a new stamp from this machine.
+#
+# Each machine keeps a version vector (the highest counter it has of every replica), so
+# that only the records the other side hasn't got yet are exchanged. Records are
+# exchanged either through a shared directory, where every machine publishes files of
+# its own changes and reads the files of the others, or directly over a socket
+
+RECORD_ORDER = {'channel': 0, 'entry': 1, 'seen': 2}
+DELTA_FILE_PATTERN = re.compile(r'^(\d+)-(\d+)\.json$')
+
+"""
+classes
+"""
+
+# the records as last synced, the version vector and the Lamport clock of this machine
+class SyncState:
+    def __init__(self, filename=constants.SYNC_STATE_PATH):
+        self.filename = filename
+        state = {}
+        if os.path.isfile(filename):
+            with open(filename, 'r') as filePointer:
+                state = json.load(filePointer)
+        self.replicaId = state.get('replica id', secrets.token_hex(8))
+        self.clock = state.get('clock', 0)
+        self.vector = state.get('vector', {})
+        # record key to [counter, replica id, value]
+        self.records = state.get('records', {})
+        # the highest counter of this machine published to a sync directory
+        self.published = state.get('published', 0)
+
+    def save(self):
+        state = {'replica id': self.replicaId, 'clock': self.clock, 'vector': self.vector,
+                'records': self.records, 'published': self.published}
+        temporaryFilename = f"{self.filename}.{os.getpid()}.tmp"
+        with open(temporaryFilename, 'w') as filePointer:
+            json.dump(state, filePointer, separators=(',', ':'))
+            filePointer.flush()
+            os.fsync(filePointer.fileno())
+        os.replace(temporaryFilename, self.filename)
+
+    def stamp(self, key, value):
+        self.clock += 1
+        self.records[key] = [self.clock, self.replicaId, value]
+        self.vector[self.replicaId] = self.clock
+
+    # give new stamps to the records changed in the database since the last sync;
+    # returns the number of changed records. The seen-state of an entry isn't stamped
+    # while it still has its default value (unseen): it is kept with counter 0, so that
+    # any explicit seen flip, from any replica, wins over it
+    def scanDatabase(self, database):
+        current = {}
+        for channelId, channelTitle in database['id to title'].items():
+            current[f"channel:{channelId}"] = channelTitle
+        for channelId, feed in database['feeds'].items():
+            # oldest first, so that newer entries get higher stamps and are put first in
+            # the feeds of other replicas
+            for entry in reversed(feed):
+                current[f"entry:{channelId}:{entry.videoId}"] = entry.title
+                current[f"seen:{entry.videoId}"] = entry.seen
+        for key, record in self.records.items():
+            if key.startswith('channel:') and key not in current and \
+                    record[2] is not None:
+                # unsubscribed
+                current[key] = None
+        nChanged = 0
+        for key, value in current.items():
+            record = self.records.get(key)
+            if record is None and key.startswith('seen:') and value is False:
+                self.records[key] = [0, '', False]
+            elif record is None or record[2] != value:
+                self.stamp(key, value)
+                nChanged += 1
+        return nChanged
+
+    # get the records that a replica with the given version vector hasn't got, as
+    # [key, counter, replica id, value]
+    def getDelta(self, vector, origin=None):
+        return [[key] + record for key, record in self.records.items()
+                if record[0] > vector.get(record[1], 0)
+                and (origin is None or record[1] == origin)]
+
+    # apply records received from another replica to the database, where they win over
+    # the local records; returns the number of records applied. Entries received are
+    # recorded in changeLog (by default, the change log of the database file)
+    def applyDelta(self, database, delta, changeLog=None):
+        delta = sorted(delta, key=lambda record: (
+            RECORD_ORDER[record[0].split(':')[0]], record[1], record[2]))
+        entriesById = {entry.videoId: entry for feed in database['feeds'].values()
+                for entry in feed}
+        if changeLog is None:
+            changeLog = database_management.getChangeLog()
+        nApplied = 0
+        for key, counter, replicaId, value in delta:
+            self.clock = max(self.clock, counter)
+            record = self.records.get(key)
+            if record is not None and (record[0], record[1]) >= (counter, replicaId):
+                continue
+            self.records[key] = [counter, replicaId, value]
+            applyRecord(database, key, value, entriesById, changeLog)
+            nApplied += 1
+        changeLog.flush()
+        return nApplied
+
+    def mergeVector(self, vector):
+        for replicaId, counter in vector.items():
+            self.vector[replicaId] = max(self.vector.get(replicaId, 0), counter)
+
+# serves syncs to replicas connecting with syncWithPeer
+class SyncRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.syncLock:
+            with SyncSession(self.server.statePath) as session:
+                peerVector = readMessage(self.rfile)['vector']
+                delta = session.state.getDelta(peerVector)
+                writeMessage(self.wfile, {'records': delta,
+                    'vector': session.state.vector})
+                message = readMessage(self.rfile)
+                received = session.state.applyDelta(session.database, message['records'])
+                session.state.mergeVector(message['vector'])
+                writeMessage(self.wfile, {'applied': received})
+
+class UnixSyncServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, statePath):
+        self.statePath = statePath
+        self.syncLock = threading.Lock()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        socketserver.UnixStreamServer.__init__(self, socketPath, SyncRequestHandler)
+
+class TcpSyncServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, statePath):
+        self.statePath = statePath
+        self.syncLock = threading.Lock()
+        socketserver.TCPServer.__init__(self, address, SyncRequestHandler)
+
+# holds the sync state and the loaded database for the duration of a sync, with the
+# sync state locked; local changes are stamped on entering, and the database and sync
+# state are saved on leaving (unless the sync failed)
+class SyncSession:
+    def __init__(self, statePath=constants.SYNC_STATE_PATH,
+            databasePath=constants.DATABASE_PATH):
+        self.statePath = statePath
+        self.databaseCache = database_management.getDatabaseCache(databasePath)
+
+    def __enter__(self):
+        self.lock = database_management.lockDatabaseFile(self.statePath)
+        self.lock.__enter__()
+        try:
+            self.state = SyncState(self.statePath)
+            self.database = self.databaseCache.load()
+            self.state.scanDatabase(self.database)
+        except BaseException as e:
+            self.lock.__exit__(type(e), e, e.__traceback__)
+            raise
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        try:
+            if exceptionType is None:
+                self.databaseCache.save()
+                self.state.save()
+        finally:
+            self.lock.__exit__(exceptionType, exception, traceback)
+
+"""
+functions
+"""
+
+# use this function to apply the value of a synced record to the database
+def applyRecord(database, key, value, entriesById, changeLog):
+    kind, _, name = key.partition(':')
+    if kind == 'channel':
+        channelId = name
+        if value is None:
+            if channelId in database['id to title']:
+                database['title to id'].pop(database['id to title'].pop(channelId), None)
+                database['feeds'].pop(channelId, None)
+        else:
+            oldTitle = database['id to title'].get(channelId)
+            if oldTitle is not None:
+                database['title to id'].pop(oldTitle, None)
+            database['id to title'][channelId] = value
+            database['title to id'][value] = channelId
+            database['feeds'].setdefault(channelId, [])
+    elif kind == 'entry':
+        channelId, videoId = name.split(':')
+        if channelId not in database['feeds']:
+            return
+        if videoId in entriesById:
+            entriesById[videoId]['title'] = value
+            return
+        entry = database_management.FeedEntry(videoId, value)
+        database_management.mergeEntriesIntoFeed(database['feeds'][channelId], [entry])
+        entriesById[videoId] = entry
+        changeLog.record(channelId, 'new', entry)
+    elif kind == 'seen':
+        if name in entriesById:
+            entriesById[name]['seen'] = value
+
+def writeMessage(filePointer, message):
+    filePointer.write(json.dumps(message, separators=(',', ':')).encode() + b'\n')
+    filePointer.flush()
+
+def readMessage(filePointer):
+    line = filePointer.readline()
+    if not line:
+        raise SyncFailed("the other side closed the connection")
+    return json.loads(line)
+
+# use this function to get the socket address given by a string: a unix socket path, or
+# host:port for TCP
+def getSocketAddress(address):
+    if '/' not in address and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+# use this function to serve syncs on a socket until interrupted
+def runSyncServer(address=constants.SYNC_SOCKET_PATH, statePath=constants.SYNC_STATE_PATH):
+    family, socketAddress = getSocketAddress(address)
+    if family == socket.AF_UNIX:
+        server = UnixSyncServer(socketAddress, statePath)
+    else:
+        server = TcpSyncServer(socketAddress, statePath)
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if family == socket.AF_UNIX:
+                os.remove(socketAddress)
+
+# use this function to sync with a replica serving syncs on a socket. Returns the number
+# of records sent and the number of records received and applied
+def syncWithPeer(address=constants.SYNC_SOCKET_PATH, statePath=constants.SYNC_STATE_PATH,
+        timeout=constants.TOTAL_TIMEOUT):
+    family, socketAddress = getSocketAddress(address)
+    with SyncSession(statePath) as session:
+        with socket.socket(family, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(socketAddress)
+            with connection.makefile('rwb') as filePointer:
+                writeMessage(filePointer, {'vector': session.state.vector})
+                message = readMessage(filePointer)
+                received = session.state.applyDelta(session.database, message['records'])
+                session.state.mergeVector(message['vector'])
+                delta = session.state.getDelta(message['vector'])
+                writeMessage(filePointer, {'records': delta,
+                    'vector': session.state.vector})
+                readMessage(filePointer)
+    return len(delta), received
+
+# use this function to sync through a directory shared between machines (e.g. through a
+# file synchronization tool or a network file system). Changes of this machine are
+# published as files under <directory>/<replica id>/, and the files published by the
+# other machines are read. Files that every other machine has read are removed. Returns
+# the number of records published and the number of records received and applied
+def syncWithDirectory(directory, statePath=constants.SYNC_STATE_PATH):
+    with SyncSession(statePath) as session:
+        state = session.state
+        ownDirectory = os.path.join(directory, state.replicaId)
+        os.makedirs(ownDirectory, exist_ok=True)
+
+        delta = state.getDelta({state.replicaId: state.published}, origin=state.replicaId)
+        if delta:
+            lastCounter = max([record[1] for record in delta])
+            writeJsonFile(os.path.join(ownDirectory,
+                f"{state.published+1:012d}-{lastCounter:012d}.json"), delta)
+            state.published = lastCounter
+
+        received = 0
+        peerVectors = []
+        for replicaId in sorted(os.listdir(directory)):
+            peerDirectory = os.path.join(directory, replicaId)
+            if replicaId == state.replicaId or not os.path.isdir(peerDirectory):
+                continue
+            for fileName in sorted(os.listdir(peerDirectory)):
+                match = DELTA_FILE_PATTERN.match(fileName)
+                if match is None or int(match.group(2)) <= state.vector.get(replicaId, 0):
+                    continue
+                with open(os.path.join(peerDirectory, fileName), 'r') as filePointer:
+                    received += state.applyDelta(session.database, json.load(filePointer))
+                state.mergeVector({replicaId: int(match.group(2))})
+            vectorPath = os.path.join(peerDirectory, 'vector.json')
+            if os.path.isfile(vectorPath):
+                with open(vectorPath, 'r') as filePointer:
+                    peerVectors.append(json.load(filePointer))
+        writeJsonFile(os.path.join(ownDirectory, 'vector.json'), state.vector)
+
+        if peerVectors:
+            readByAll = min([vector.get(state.replicaId, 0) for vector in peerVectors])
+            for fileName in os.listdir(ownDirectory):
+                match = DELTA_FILE_PATTERN.match(fileName)
+                if match is not None and int(match.group(2)) <= readByAll:
+                    os.remove(os.path.join(ownDirectory, fileName))
+    return len(delta), received
+
+# use this function to write a json file atomically, so that other machines never read a
+# partially written file
+def writeJsonFile(filename, content):
+    temporaryFilename = f"{filename}.{os.getpid()}.tmp"
+    with open(temporaryFilename, 'w') as filePointer:
+        json.dump(content, filePointer, separators=(',', ':'))
+        filePointer.flush()
+        os.fsync(filePointer.fileno())
+    os.replace(temporaryFilename, filename)
+
+"""
+Exception classes
+"""
+
+# indicates that a sync with another replica failed
+class SyncFailed(Exception):
+    pass
@@ -0,0 +1,88 @@
+import os
+import json
+import socket
+import tempfile
+import unittest
+import threading
+import player_controller
+
+# a stand-in for mpv's JSON IPC server, which "plays" every loaded file by sending the
+# events mpv sends for it: the path changing to the file, then the file ending with
+# the given reason (after which the path is unset)
+class FakeMpv:
+    def __init__(self, socketPath, endReasons={}):
+        self.endReasons = endReasons
+        self.commands = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socketPath)
+        self.server.listen(1)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        connection, _ = self.server.accept()
+        with connection:
+            for line in connection.makefile('rb'):
+                command = json.loads(line)['command']
+                self.commands.append(command)
+                if command[0] == 'quit':
+                    return
+                if command[0] == 'loadfile':
+                    reason = self.endReasons.get(command[1], 'eof')
+                    for event in [{'event': 'property-change', 'name': 'path',
+                            'data': command[1]}, {'event': 'end-file', 'reason': reason},
+                            {'event': 'property-change', 'name': 'path', 'data': None}]:
+                        connection.sendall((json.dumps(event) + '\n').encode())
+
+    def close(self):
+        self.server.close()
+
+class TestMpvController(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.finished = []
+        self.finishedCondition = threading.Condition()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def onFinished(self, url):
+        with self.finishedCondition:
+            self.finished.append(url)
+            self.finishedCondition.notify_all()
+
+    def getController(self, endReasons={}):
+        def launchFakeMpv(socketPath):
+            self.mpv = FakeMpv(socketPath, endReasons)
+            return None
+        return player_controller.MpvController(
+                socketPath=os.path.join(self.directory.name, 'mpv-socket'),
+                onFinished=self.onFinished, launchCommand=launchFakeMpv)
+
+    def playAndQuit(self, controller, urls, nFinished):
+        controller.play(urls[0])
+        controller.queue(urls[1:])
+        with self.finishedCondition:
+            self.assertTrue(self.finishedCondition.wait_for(
+                lambda : len(self.finished) >= nFinished, timeout=5))
+        controller.quit()
+        self.mpv.thread.join(5)
+        self.mpv.close()
+
+    def testFinishedFilesAreReportedInOrder(self):
+        controller = self.getController()
+        self.playAndQuit(controller, ['https://www.youtube.com/watch?v=aaaaaaaaaaa',
+            'https://www.youtube.com/watch?v=bbbbbbbbbbb'], 2)
+        self.assertEqual(self.finished, ['https://www.youtube.com/watch?v=aaaaaaaaaaa',
+            'https://www.youtube.com/watch?v=bbbbbbbbbbb'])
+        self.assertEqual(self.mpv.commands[0], ['observe_property', 1, 'path'])
+
+    def testFilesThatDidNotEndAreNotReported(self):
+        controller = self.getController(
+                {'https://www.youtube.com/watch?v=aaaaaaaaaaa': 'stop'})
+        self.playAndQuit(controller, ['https://www.youtube.com/watch?v=aaaaaaaaaaa',
+            'https://www.youtube.com/watch?v=bbbbbbbbbbb'], 1)
+        self.assertEqual(self.finished, ['https://www.youtube.com/watch?v=bbbbbbbbbbb'])
+
+if __name__ == '__main__':
+    unittest.main()
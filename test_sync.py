@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+import sync
+import database_management
+
+CHANNEL_ID = 'UC' + 'x'*22
+
+# a replica with its own sync state and in-memory database
+class Replica:
+    def __init__(self, directory, name):
+        self.state = sync.SyncState(os.path.join(directory, f"{name}-sync-state"))
+        self.changeLog = database_management.ChangeLog(os.path.join(directory,
+            f"{name}-changelog"))
+        self.database = database_management.initiateYouTubeRssDatabase()
+        self.database['id to title'][CHANNEL_ID] = 'X'
+        self.database['title to id']['X'] = CHANNEL_ID
+        self.database['feeds'][CHANNEL_ID] = []
+
+    def refresh(self, videoIds):
+        database_management.mergeEntriesIntoFeed(self.database['feeds'][CHANNEL_ID],
+                [database_management.FeedEntry(videoId, f"title of {videoId}")
+                    for videoId in videoIds])
+
+    def getEntry(self, videoId):
+        return [entry for entry in self.database['feeds'][CHANNEL_ID]
+                if entry.videoId == videoId][0]
+
+# use this function to sync two replicas the way syncWithPeer does
+def doSync(client, server):
+    client.state.scanDatabase(client.database)
+    server.state.scanDatabase(server.database)
+    client.state.applyDelta(client.database, server.state.getDelta(client.state.vector),
+            client.changeLog)
+    client.state.mergeVector(server.state.vector)
+    server.state.applyDelta(server.database, client.state.getDelta(server.state.vector),
+            server.changeLog)
+    server.state.mergeVector(client.state.vector)
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.a = Replica(self.directory.name, 'a')
+        self.b = Replica(self.directory.name, 'b')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # both replicas refresh the same video, and only A's user marks it as seen; the
+    # default seen-state of B's copy must not win, even with B's clock ahead
+    def testSeenFlipWinsOverRefreshedDefault(self):
+        self.b.state.clock = 1000
+        self.a.refresh(['video00001'])
+        self.b.refresh(['video00001'])
+        self.a.getEntry('video00001')['seen'] = True
+        doSync(self.a, self.b)
+        self.assertTrue(self.a.getEntry('video00001')['seen'])
+        self.assertTrue(self.b.getEntry('video00001')['seen'])
+        doSync(self.b, self.a)
+        self.assertTrue(self.a.getEntry('video00001')['seen'])
+        self.assertTrue(self.b.getEntry('video00001')['seen'])
+
+    # a seen flip made after seeing another replica's flip wins over it
+    def testLaterSeenFlipWins(self):
+        self.a.refresh(['video00001'])
+        self.b.refresh(['video00001'])
+        self.a.getEntry('video00001')['seen'] = True
+        doSync(self.a, self.b)
+        self.b.getEntry('video00001')['seen'] = False
+        doSync(self.a, self.b)
+        self.assertFalse(self.a.getEntry('video00001')['seen'])
+        self.assertFalse(self.b.getEntry('video00001')['seen'])
+
+    def testNewEntriesAreExchanged(self):
+        self.a.refresh(['video00001', 'video00002'])
+        doSync(self.a, self.b)
+        self.assertEqual([entry.videoId for entry in self.b.database['feeds'][CHANNEL_ID]],
+                ['video00002', 'video00001'])
+        self.assertEqual(len(self.b.changeLog.since(0)), 2)
+
+if __name__ == '__main__':
+    unittest.main()
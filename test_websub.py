@@ -0,0 +1,150 @@
+import os
+import hmac
+import time
+import hashlib
+import tempfile
+import unittest
+import threading
+import http.server
+import urllib.parse
+import urllib.request
+import websub
+import connection_management
+
+CHANNEL_ID = 'UC' + 'x'*22
+TOPIC = connection_management.getRssAddressFromChannelId(CHANNEL_ID)
+FEED_CONTENT = f"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom">
+<entry><yt:videoId>video000001</yt:videoId><yt:channelId>{CHANNEL_ID}</yt:channelId>
+<title>A new video</title></entry></feed>""".encode()
+
+# a local stand-in for a WebSub hub, which verifies (un)subscription requests by calling
+# back the subscriber, and can push content to verified subscribers
+class StandInHub(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.requests = []
+        self.verified = {}
+        self.verifiedEvent = threading.Event()
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StandInHubHandler)
+
+    def getUrl(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def verify(self, request):
+        challenge = f"challenge-{len(self.requests)}"
+        query = urllib.parse.urlencode({'hub.mode': request['hub.mode'],
+            'hub.topic': request['hub.topic'], 'hub.challenge': challenge,
+            'hub.lease_seconds': request['hub.lease_seconds']})
+        with urllib.request.urlopen(f"{request['hub.callback']}?{query}") as response:
+            echoed = response.read().decode() == challenge
+        if echoed:
+            self.verified[request['hub.topic']] = request
+            self.verifiedEvent.set()
+
+    def push(self, topic, content, secret=None):
+        request = self.verified[topic]
+        headers = {}
+        if secret is not None:
+            digest = hmac.new(secret.encode(), content, hashlib.sha1).hexdigest()
+            headers['X-Hub-Signature'] = f"sha1={digest}"
+        urllib.request.urlopen(urllib.request.Request(request['hub.callback'],
+            data=content, headers=headers, method='POST')).close()
+
+class StandInHubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        self.server.requests.append(request)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        # verification is asynchronous, as with real hubs
+        threading.Thread(target=self.server.verify, args=(request,), daemon=True).start()
+
+    def log_message(self, format, *args):
+        pass
+
+class TestWebSub(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.hub = StandInHub()
+        threading.Thread(target=self.hub.serve_forever, daemon=True).start()
+        self.channelIds = [CHANNEL_ID]
+        self.pushed = []
+        self.manager = self.getManager()
+
+    def tearDown(self):
+        self.manager.stop()
+        self.hub.shutdown()
+        self.hub.server_close()
+        self.directory.cleanup()
+
+    def getManager(self):
+        manager = websub.WebSubManager(None, lambda : self.channelIds,
+                lambda channelId, content : self.pushed.append((channelId, content)),
+                hubUrl=self.hub.getUrl(), listenAddress=('127.0.0.1', 0),
+                maintenanceInterval=3600,
+                statePath=os.path.join(self.directory.name, 'websub-state'))
+        manager.server = websub.WebSubCallbackServer(manager.listenAddress, manager)
+        manager.callbackUrl = f"http://127.0.0.1:{manager.server.server_address[1]}/"
+        threading.Thread(target=manager.server.serve_forever, daemon=True).start()
+        return manager
+
+    def subscribe(self):
+        self.hub.verifiedEvent.clear()
+        self.manager.maintain()
+        self.assertTrue(self.hub.verifiedEvent.wait(5))
+        self.waitFor(lambda : CHANNEL_ID not in self.manager.pending)
+
+    def waitFor(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def testSubscriptionIsVerifiedAndLeased(self):
+        self.subscribe()
+        self.assertEqual(self.hub.requests[0]['hub.mode'], 'subscribe')
+        self.assertEqual(self.hub.requests[0]['hub.topic'], TOPIC)
+        self.assertGreater(self.manager.leases[CHANNEL_ID], time.time())
+
+    def testSignedPushIsDelivered(self):
+        self.subscribe()
+        self.hub.push(TOPIC, FEED_CONTENT, self.hub.requests[0]['hub.secret'])
+        self.assertEqual(self.pushed, [(CHANNEL_ID, FEED_CONTENT)])
+
+    def testUnsignedOrWronglySignedPushIsDropped(self):
+        self.subscribe()
+        self.hub.push(TOPIC, FEED_CONTENT)
+        self.hub.push(TOPIC, FEED_CONTENT, 'not the secret')
+        self.assertEqual(self.pushed, [])
+
+    def testExpiringLeaseIsRenewed(self):
+        self.subscribe()
+        self.manager.leases[CHANNEL_ID] = time.time() + 10
+        self.subscribe()
+        self.assertEqual(len(self.hub.requests), 2)
+        self.assertGreater(self.manager.leases[CHANNEL_ID], time.time() + 3600)
+
+    def testDroppedChannelIsUnsubscribed(self):
+        self.subscribe()
+        self.channelIds = []
+        self.subscribe()
+        self.assertEqual(self.hub.requests[-1]['hub.mode'], 'unsubscribe')
+        self.assertNotIn(CHANNEL_ID, self.manager.leases)
+
+    # a verification that arrives after a restart is still accepted
+    def testPendingRequestSurvivesRestart(self):
+        self.manager.pending[CHANNEL_ID] = ('subscribe', time.time() + 3600)
+        self.manager.saveState()
+        self.manager.stop()
+        self.manager = self.getManager()
+        challenge = self.manager.handleVerification({'hub.mode': 'subscribe',
+            'hub.topic': TOPIC, 'hub.challenge': 'abc', 'hub.lease_seconds': '60'})
+        self.assertEqual(challenge, 'abc')
+        self.assertIn(CHANNEL_ID, self.manager.leases)
+
+if __name__ == '__main__':
+    unittest.main()
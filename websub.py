@@ -0,0 +1,242 @@
+import os
+import re
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+import secrets
+import aiohttp
+import threading
+import http.server
+import urllib.parse
+import constants
+import connection_management
+
+"""
+classes
+"""
+
+# manages WebSub (PubSubHubbub) push subscriptions to the feeds of subscribed channels,
+# as an alternative to polling every feed. It runs a small callback receiver that the
+# hub pushes new uploads to, keeps the hub subscriptions of all channels (returned by
+# getChannelIds) leased, and calls onFeedContent(channelId, content) with every pushed
+# Atom payload. Since pushes can get lost, sweep is called every sweepInterval seconds
+# to poll all feeds as a slow consistency check.
+# The callback receiver listens on listenAddress, and the hub must be able to reach it
+# on callbackUrl (typically through a reverse proxy or port forward)
+class WebSubManager:
+    def __init__(self, callbackUrl, getChannelIds, onFeedContent, sweep=None,
+            hubUrl=constants.WEBSUB_HUB_URL,
+            listenAddress=(constants.WEBSUB_LISTEN_HOST, constants.WEBSUB_LISTEN_PORT),
+            leaseSeconds=constants.WEBSUB_LEASE_SECONDS,
+            renewMargin=constants.WEBSUB_RENEW_MARGIN,
+            sweepInterval=constants.WEBSUB_SWEEP_INTERVAL,
+            maintenanceInterval=60, statePath=constants.WEBSUB_STATE_PATH,
+            useTor=False, circuitManager=None):
+        self.callbackUrl = callbackUrl
+        self.getChannelIds = getChannelIds
+        self.onFeedContent = onFeedContent
+        self.sweep = sweep
+        self.hubUrl = hubUrl
+        self.listenAddress = listenAddress
+        self.leaseSeconds = leaseSeconds
+        self.renewMargin = renewMargin
+        self.sweepInterval = sweepInterval
+        self.maintenanceInterval = maintenanceInterval
+        self.statePath = statePath
+        self.useTor = useTor
+        self.circuitManager = circuitManager
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.server = None
+        self.threads = []
+        self.loadState()
+
+    # the state holds the shared secret used for signing pushes, the lease expiry time of
+    # every verified subscription, and the topics with requests awaiting verification
+    # (which are kept across restarts, since the hub may verify them after a restart)
+    def loadState(self):
+        state = {}
+        if self.statePath is not None and os.path.isfile(self.statePath):
+            with open(self.statePath, 'r') as filePointer:
+                state = json.load(filePointer)
+        self.secret = state.get('secret', secrets.token_hex(20))
+        self.leases = state.get('leases', {})
+        self.pending = {channelId: tuple(request) for channelId, request
+                in state.get('pending', {}).items()}
+        self.lastSweepTime = state.get('last sweep', 0)
+
+    def saveState(self):
+        if self.statePath is None:
+            return
+        with self.lock:
+            state = {'secret': self.secret, 'leases': self.leases,
+                    'pending': self.pending, 'last sweep': self.lastSweepTime}
+        with open(self.statePath, 'w') as filePointer:
+            json.dump(state, filePointer)
+
+    def start(self):
+        self.server = WebSubCallbackServer(self.listenAddress, self)
+        self.threads = [threading.Thread(target=self.server.serve_forever, daemon=True),
+                threading.Thread(target=self.maintenanceLoop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def maintenanceLoop(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.maintain()
+            except Exception:
+                pass
+            self.stopEvent.wait(self.maintenanceInterval)
+
+    # subscribe to new channels, renew leases that are about to expire, unsubscribe from
+    # channels that are no longer subscribed to, and run the consistency sweep when due
+    def maintain(self):
+        now = time.time()
+        channelIds = set(self.getChannelIds())
+        with self.lock:
+            leasedChannelIds = set(self.leases)
+            toSubscribe = [channelId for channelId in channelIds
+                    if self.leases.get(channelId, 0) - self.renewMargin < now
+                    and self.pending.get(channelId, (None, 0))[1] < now]
+            toUnsubscribe = [channelId for channelId in leasedChannelIds - channelIds
+                    if self.pending.get(channelId, (None, 0))[1] < now]
+        for channelId in toSubscribe:
+            self.requestSubscription(channelId, 'subscribe')
+        for channelId in toUnsubscribe:
+            self.requestSubscription(channelId, 'unsubscribe')
+        if self.sweep is not None and now - self.lastSweepTime > self.sweepInterval:
+            self.sweep()
+            self.lastSweepTime = time.time()
+        self.saveState()
+
+    # send a (un)subscription request for a channel to the hub. The hub verifies it
+    # asynchronously, by calling the callback receiver
+    def requestSubscription(self, channelId, mode='subscribe'):
+        with self.lock:
+            # a request that isn't verified within the maintenance interval is resent
+            self.pending[channelId] = (mode, time.time() + 10*self.maintenanceInterval)
+        self.saveState()
+        data = {
+            'hub.callback'      : self.callbackUrl,
+            'hub.topic'         : connection_management.getRssAddressFromChannelId(
+                                        channelId),
+            'hub.verify'        : 'async',
+            'hub.mode'          : mode,
+            'hub.lease_seconds' : str(self.leaseSeconds),
+            'hub.secret'        : self.secret
+        }
+        auth = None
+        if self.useTor and self.circuitManager is not None:
+            auth = self.circuitManager.getAuth()
+        return asyncio.run(postHubRequest(self.hubUrl, data, self.useTor, auth))
+
+    # handle a verification request from the hub; returns the challenge to echo if the
+    # request matches one we have sent, otherwise None
+    def handleVerification(self, parameters):
+        mode = parameters.get('hub.mode')
+        channelId = getChannelIdFromTopic(parameters.get('hub.topic', ''))
+        challenge = parameters.get('hub.challenge')
+        if channelId is None or challenge is None:
+            return None
+        with self.lock:
+            pendingMode = self.pending.get(channelId, (None, 0))[0]
+            if mode != pendingMode:
+                return None
+            self.pending.pop(channelId)
+            if mode == 'subscribe':
+                leaseSeconds = int(parameters.get('hub.lease_seconds', self.leaseSeconds))
+                self.leases[channelId] = time.time() + leaseSeconds
+            else:
+                self.leases.pop(channelId, None)
+        self.saveState()
+        return challenge
+
+    # handle content pushed by the hub; returns whether it was accepted
+    def handleNotification(self, content, signature):
+        if not isValidSignature(self.secret, content, signature):
+            return False
+        channelId = getChannelIdFromFeedContent(content)
+        if channelId is None or channelId not in set(self.getChannelIds()):
+            return False
+        self.onFeedContent(channelId, content)
+        return True
+
+# receives verification requests and pushed content from the hub
+class WebSubCallbackHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parameters = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        challenge = self.server.manager.handleVerification(parameters)
+        if challenge is None:
+            self.sendResponse(404)
+        else:
+            self.sendResponse(200, challenge.encode())
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        content = self.rfile.read(length)
+        self.server.manager.handleNotification(content,
+                self.headers.get('X-Hub-Signature'))
+        # the hub is always told that the content was received, as the spec requires
+        self.sendResponse(204)
+
+    def sendResponse(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class WebSubCallbackServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, listenAddress, manager):
+        self.manager = manager
+        http.server.ThreadingHTTPServer.__init__(self, listenAddress,
+                WebSubCallbackHandler)
+
+"""
+functions
+"""
+
+# use this function to send a form encoded request to a WebSub hub; returns whether the
+# hub accepted it
+async def postHubRequest(hubUrl, data, useTor=False, auth=None):
+    connector = connection_management.getConnector(useTor, auth)
+    async with aiohttp.ClientSession(connector=connector,
+            timeout=connection_management.getRequestTimeout()) as session:
+        async with session.post(hubUrl, data=data) as response:
+            return response.status in [202, 204]
+
+# use this function to check the X-Hub-Signature of pushed content
+def isValidSignature(secret, content, signature):
+    if signature is None or '=' not in signature:
+        return False
+    method, digest = signature.split('=', 1)
+    if method not in ['sha1', 'sha256', 'sha384', 'sha512']:
+        return False
+    expected = hmac.new(secret.encode(), content, getattr(hashlib, method)).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+def getChannelIdFromTopic(topic):
+    match = re.search(r'channel_id=(UC[\w-]{22})', topic)
+    return match.group(1) if match is not None else None
+
+# use this function to get the channel id that pushed Atom content is about
+def getChannelIdFromFeedContent(content):
+    if isinstance(content, bytes):
+        content = content.decode(errors='replace')
+    match = re.search(r'<yt:channelId>(UC[\w-]{22})</yt:channelId>', content)
+    if match is None:
+        return getChannelIdFromTopic(content)
+    return match.group(1)
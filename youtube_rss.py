@@ -20,6 +20,14 @@
 
 #   Contact by email: simon@simonssoffa.xyz
 
+import sys
+import command_line
+
+# non-interactive subcommands are dispatched before the rest of the application (and the
+# libraries it depends on) is imported, so that they start quickly
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in command_line.COMMANDS:
+    sys.exit(command_line.main(sys.argv[1:]))
+
 import socket
 import os
 import aiohttp
@@ -31,6 +39,13 @@ import connection_management
 import shutil
 import database_management
 import method_menu
+import import_export
+import stream_resolution
+import player_controller
+import download_management
+import api_server
+import api_client
+import profiling
 
 """
 Application control flow
@@ -46,9 +61,14 @@ def doInteractiveSearchForVideo(useTor=False, circuitManager=None):
             auth = None
             if useTor and circuitManager is not None:
                 auth = circuitManager.getAuth()
-            resultList = presentation.doWaitScreen("Getting video results...", 
-                    connection_management.getVideoQueryResults, query,
-                    useTor=useTor, auth=auth)
+            if database_management.apiClient is not None:
+                # the server searches on behalf of all of its clients
+                resultList = presentation.doWaitScreen("Getting video results...",
+                        database_management.apiClient.getVideoQueryResults, query)
+            else:
+                resultList = presentation.doWaitScreen("Getting video results...", 
+                        connection_management.getVideoQueryResults, query,
+                        useTor=useTor, auth=auth)
             if resultList:
                 menuOptions = [
                     method_menu.MethodMenuDecision(
@@ -80,9 +100,13 @@ def doInteractiveChannelSubscribe(useTor=False, circuitManager=None):
             auth = None
             if useTor and circuitManager is not None:
                 auth = circuitManager.getAuth()
-            resultList = presentation.doWaitScreen("Getting channel results...", 
-                    connection_management.getChannelQueryResults, query, useTor=useTor, 
-                    auth=auth)
+            if database_management.apiClient is not None:
+                resultList = presentation.doWaitScreen("Getting channel results...",
+                        database_management.apiClient.getChannelQueryResults, query)
+            else:
+                resultList = presentation.doWaitScreen("Getting channel results...", 
+                        connection_management.getChannelQueryResults, query,
+                        useTor=useTor, auth=auth)
             if resultList:
                 menuOptions = [
                     method_menu.MethodMenuDecision(
@@ -107,7 +131,7 @@ def doInteractiveChannelSubscribe(useTor=False, circuitManager=None):
 # this is the application level flow entered when the user has chosen a channel that it
 # wants to subscribe to
 def doChannelSubscribe(result, useTor, circuitManager):
-    database = presentation.doWaitScreen('', database_management.parseDatabaseFile, constants.DATABASE_PATH)
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
     refreshing = True
     if result.channelId in database['feeds']:
         presentation.doNotify("Already subscribed to this channel!")
@@ -129,7 +153,7 @@ def doChannelSubscribe(result, useTor, circuitManager):
 # this is the application level flow entered when the user has chosen to unsubscribe to 
 # a channel
 def doInteractiveChannelUnsubscribe():
-    database = presentation.doWaitScreen('', database_management.parseDatabaseFile, constants.DATABASE_PATH)
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
     if not database['title to id']:
         presentation.doNotify('You are not subscribed to any channels')
         return
@@ -146,17 +170,23 @@ def doInteractiveChannelUnsubscribe():
 # this is the application level flow entered when the user has chosen a channel that it
 # wants to unsubscribe from
 def doChannelUnsubscribe(channelTitle):
-    database = presentation.doWaitScreen('', database_management.parseDatabaseFile, constants.DATABASE_PATH)
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
     database_management.removeSubscriptionFromDatabaseByChannelTitle(database, channelTitle)
-    database_management.outputDatabaseToFile(database, constants.DATABASE_PATH)
+    database_management.saveDatabase(database)
     return indicator_classes.ReturnFromMenu
 
 # this is the application level flow entered when the user has chosen to browse
 # its current subscriptions
-def doInteractiveBrowseSubscriptions(useTor, circuitManager):
-    database = presentation.doWaitScreen('', database_management.parseDatabaseFile, constants.DATABASE_PATH)
-    menuOptions = [
-        method_menu.MethodMenuDecision(
+def doInteractiveBrowseSubscriptions(useTor, circuitManager, streamResolver=None,
+        playerController=None, downloadManager=None):
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
+    if not database['title to id']:
+        presentation.doNotify('You are not subscribed to any channels')
+        return
+
+    menuOptions = method_menu.LazyMenuOptions(
+        list(database['title to id']),
+        lambda channelTitle : method_menu.MethodMenuDecision(
             method_menu.FeedDescriber(
                 database['feeds'][database['title to id'][channelTitle]],
                 channelTitle
@@ -164,83 +194,202 @@ def doInteractiveBrowseSubscriptions(useTor, circuitManager):
             database,
             channelTitle,
             useTor,
-            circuitManager
-        ) for channelTitle in database['title to id']
-    ]
-
-    adHocKeys = [
-        method_menu.MarkAllAsReadKey(
-            channelId,
-            i+1,
+            circuitManager,
+            streamResolver,
+            playerController,
+            downloadManager
+        ), header=[method_menu.MethodMenuDecision('[Go back]', method_menu.doReturnFromMenu)]
+    )
+
+    adHocKeys = presentation.AdHocKeyTable()
+    adHocKeys.addForRows(
+        ord('a'),
+        lambda i : method_menu.MarkAllAsReadKey(
+            database['title to id'][menuOptions.getItem(i)],
+            i,
             database
-        ) for i, channelId in enumerate(database['feeds'])
-    ]
-
-    if not menuOptions:
-        presentation.doNotify('You are not subscribed to any channels')
-        return
+        ), menuOptions.getItemRows()
+    )
 
-    menuOptions.insert(0, method_menu.MethodMenuDecision('[Go back]', method_menu.doReturnFromMenu))
     method_menu.doMethodMenu("Which channel do you want to watch a video from?", menuOptions,
             adHocKeys = adHocKeys)
 
 # this is the application level flow entered when the user has chosen a channel while
 # browsing its current subscriptions;
 # the user now gets to select a video from the channel to watch
-def doSelectVideoFromSubscription(database, channelTitle, useTor, circuitManager):
+def doSelectVideoFromSubscription(database, channelTitle, useTor, circuitManager,
+        streamResolver=None, playerController=None, downloadManager=None):
     channelId = database['title to id'][channelTitle]
     videos = database['feeds'][channelId]
-    menuOptions = [
-        method_menu.MethodMenuDecision(
+    if playerController is not None:
+        return doSelectVideoForPlayerController(database, videos, playerController)
+    prefetchUnseenStreams(videos, streamResolver)
+    menuOptions = method_menu.LazyMenuOptions(
+        videos,
+        lambda video : method_menu.MethodMenuDecision(
             method_menu.FeedVideoDescriber(video),
             doPlayVideoFromSubscription,
             database,
             video,
             useTor,
-            circuitManager
-        ) for video in videos
-    ]
-
-    adHocKeys = [
-        method_menu.MarkEntryAsReadKey(
-            video,
-            i+1
-        ) for i, video in enumerate(videos)
-    ]
-    database_management.outputDatabaseToFile(database, constants.DATABASE_PATH)
-    menuOptions.insert(0, method_menu.MethodMenuDecision("[Go back]", method_menu.doReturnFromMenu))
+            circuitManager,
+            streamResolver,
+            videos,
+            downloadManager=downloadManager
+        ), header=[method_menu.MethodMenuDecision("[Go back]", method_menu.doReturnFromMenu)]
+    )
+
+    adHocKeys = presentation.AdHocKeyTable()
+    adHocKeys.addForRows(
+        ord('a'),
+        lambda i : method_menu.MarkEntryAsReadKey(
+            menuOptions.getItem(i),
+            i
+        ), menuOptions.getItemRows()
+    )
+    if downloadManager is not None:
+        adHocKeys.addForRows(
+            ord('d'),
+            lambda i : method_menu.DownloadEntryKey(
+                menuOptions.getItem(i),
+                i,
+                downloadManager
+            ), menuOptions.getItemRows()
+        )
     method_menu.doMethodMenu("Which video do you want to watch?", menuOptions, 
             adHocKeys=adHocKeys)
-    database_management.outputDatabaseToFile(database, constants.DATABASE_PATH)
+    database_management.saveDatabase(database)
 
 # this is the application level flow entered when the user has selected a video to watch
 # while browsing its current subscriptions
-def doPlayVideoFromSubscription(database, video, useTor, circuitManager):
-    result = playVideo(video['link'], useTor, circuitManager = circuitManager)
+def doPlayVideoFromSubscription(database, video, useTor, circuitManager,
+        streamResolver=None, videos=None, downloadManager=None):
+    result = playVideo(video['link'], useTor, circuitManager = circuitManager,
+            streamResolver = streamResolver, downloadManager = downloadManager)
     if not video['seen']:
         video['seen'] = result
-        database_management.outputDatabaseToFile(database, constants.DATABASE_PATH)
+        database_management.saveDatabase(database)
+    if videos is not None:
+        prefetchUnseenStreams(videos, streamResolver)
+
+# this is the application level flow entered when the user has chosen a channel while
+# browsing its current subscriptions, and videos are played by a long-running player;
+# videos are queued rather than played one at a time
+def doSelectVideoForPlayerController(database, videos, playerController):
+    playerController.onFinished = getMarkAsSeenCallback(database)
+    menuOptions = method_menu.LazyMenuOptions(
+        videos,
+        lambda video : method_menu.MethodMenuDecision(
+            method_menu.FeedVideoDescriber(video),
+            doQueueVideos,
+            playerController,
+            [video],
+            replace=True
+        ), header=[
+            method_menu.MethodMenuDecision("[Go back]", method_menu.doReturnFromMenu),
+            method_menu.MethodMenuDecision("[Queue all unseen]", doQueueVideos,
+                playerController, videos, unseenOnly=True)
+        ]
+    )
+    adHocKeys = presentation.AdHocKeyTable()
+    adHocKeys.addForRows(
+        ord('a'),
+        lambda i : method_menu.MarkEntryAsReadKey(
+            menuOptions.getItem(i),
+            i
+        ), menuOptions.getItemRows()
+    )
+    method_menu.doMethodMenu("Which video do you want to watch?", menuOptions, 
+            adHocKeys=adHocKeys)
+    database_management.saveDatabase(database)
+
+# this is the application level flow entered when the user has chosen to play or queue
+# videos in a long-running player
+def doQueueVideos(playerController, videos, replace=False, unseenOnly=False):
+    urls = [video['link'] for video in videos if not (unseenOnly and video['seen'])]
+    if not urls:
+        presentation.doNotify("No unseen videos to queue")
+        return
+    try:
+        if replace:
+            playerController.play(urls[0])
+            urls = urls[1:]
+        playerController.queue(urls)
+    except (OSError, player_controller.PlayerNotReachable):
+        presentation.doNotify("Could not reach the player!")
+
+# use this function to get the callback used by a long-running player for marking
+# videos as seen once they have been played to their end. The callback runs in the
+# player's reader thread, so it holds the database lock while changing the database
+def getMarkAsSeenCallback(database):
+    def markAsSeen(url):
+        with database_management.databaseLock:
+            for feed in list(database['feeds'].values()):
+                for video in feed:
+                    if video['link'] == url and not video['seen']:
+                        video['seen'] = True
+                        database_management.saveDatabase(database)
+                        return
+    return markAsSeen
+
+# use this function to start resolving the streams of the next few unseen videos of a
+# feed in the background
+def prefetchUnseenStreams(videos, streamResolver):
+    if streamResolver is None:
+        return
+    unseenUrls = [video['link'] for video in videos if not video['seen']]
+    streamResolver.prefetch(unseenUrls[:constants.PRERESOLVE_COUNT])
 
 # this is the application level flow entered when the user is watching any video from
 # YouTube
-def playVideo(videoUrl, useTor=False, circuitManager = None):
+def playVideo(videoUrl, useTor=False, circuitManager = None, streamResolver = None,
+        downloadManager = None):
     resolutionMenuList = [1080, 720, 480, 240]
-    maxResolution = presentation.doSelectionQuery("Which maximum resolution do you want to use?",
-            resolutionMenuList)
+    if downloadManager is not None and downloadManager.getLocalFile(videoUrl) is not None:
+        maxResolution = constants.DEFAULT_MAX_RESOLUTION
+    else:
+        maxResolution = presentation.doSelectionQuery("Which maximum resolution do you want to use?",
+                resolutionMenuList)
+        if streamResolver is not None:
+            # prefetch the next videos at the resolution they will likely be played at
+            streamResolver.maxResolution = maxResolution
     result = False
     while not result:
         result = presentation.doWaitScreen("playing video...", connection_management.openUrlInMpv,
-                videoUrl, useTor=useTor, maxResolution=maxResolution, circuitManager = circuitManager)
+                videoUrl, useTor=useTor, maxResolution=maxResolution, circuitManager = circuitManager,
+                streamResolver = streamResolver, downloadManager = downloadManager)
+        if not result and streamResolver is not None:
+            # the cached streams may have gone bad, so they are resolved again on retry
+            streamResolver.evict(videoUrl, maxResolution)
         if result or not presentation.doYesNoQuery(f"Something went wrong when playing the " + \
                 "video. Try again?"):
             break
     return result
 
+# this is the application level flow entered when the user has chosen to download its
+# unseen videos
+def doDownloadUnseenVideos(downloadManager):
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
+    downloadManager.queueUnseen(database['feeds'].values())
+    doShowDownloads(downloadManager)
+
+# this is the application level flow entered when the user has chosen to look at its
+# queued downloads
+def doShowDownloads(downloadManager):
+    while True:
+        jobs = downloadManager.getJobs()
+        if not jobs:
+            presentation.doNotify("No downloads queued")
+            return
+        choice = presentation.doSelectionQuery("Downloads (select to update):",
+                ['[Go back]'] + [str(job) for job in jobs], showItemNumber=False)
+        if choice == '[Go back]':
+            return
+
 # this is the application level flow entered when the user has chosen to refresh its
 # subscriptions
 def doRefreshSubscriptions(useTor=False, circuitManager=None):
-    database = presentation.doWaitScreen('', database_management.parseDatabaseFile, 
-            constants.DATABASE_PATH)
+    database = presentation.doWaitScreen('', database_management.loadDatabase)
     channelIdList = list(database['id to title'])
     refreshing = True
     while refreshing:
@@ -248,34 +397,48 @@ def doRefreshSubscriptions(useTor=False, circuitManager=None):
             auth = None
             if useTor and circuitManager is not None:
                 auth = circuitManager.getAuth()
-            presentation.doWaitScreen("refreshing subscriptions...", 
-                    database_management.refreshSubscriptionsByChannelId, channelIdList, 
-                    useTor=useTor, auth=auth)
+            if database_management.apiClient is not None:
+                # the server refreshes on behalf of all of its clients, and only shares
+                # a running refresh with requests for all channels
+                unreached = presentation.doWaitScreen("refreshing subscriptions...",
+                        database_management.apiClient.refresh, None)
+            else:
+                unreached = presentation.doWaitScreen("refreshing subscriptions...", 
+                        database_management.refreshSubscriptionsByChannelId, channelIdList, 
+                        useTor=useTor, auth=auth)
             refreshing = False
-        except aiohttp.client_exceptions.ClientConnectionError:
+            if unreached:
+                presentation.doNotify("Could not refresh (will be tried first next " + \
+                        "time): " + ', '.join([database['id to title'].get(channelId,
+                        channelId) for channelId in unreached]))
+        except (aiohttp.client_exceptions.ClientConnectionError, OSError,
+                api_client.ApiError):
             if not presentation.doYesNoQuery("Something went wrong. Try again?"):
                 refreshing = False
 
-def doStartupMenu():
+def doStartupMenu(usePlayerController=False):
     menuOptions = [
         method_menu.MethodMenuDecision(
             "Yes",
-            doStartupWithTor
+            doStartupWithTor,
+            usePlayerController=usePlayerController
         ), method_menu.MethodMenuDecision(
             "No",
-            doMainMenu
+            doMainMenu,
+            usePlayerController=usePlayerController
         )
     ]
     method_menu.doMethodMenu("Do you want to use tor?", menuOptions, showItemNumber=False)
 
-def doStartupWithTor():
+def doStartupWithTor(usePlayerController=False):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         result = sock.connect_ex(('127.0.0.1',9050))
     if result != 0:
         menuOptions = [
             method_menu.MethodMenuDecision(
                 "Yes",
-                doMainMenu
+                doMainMenu,
+                usePlayerController=usePlayerController
             ), method_menu.MethodMenuDecision(
                 "No",
                 method_menu.doNotifyAndReturnFromMenu,
@@ -285,12 +448,25 @@ def doStartupWithTor():
         method_menu.doMethodMenu("Tor daemon not found on port 9050! " + \
                 "Continue without tor?", menuOptions, showItemNumber=False)
     else:
-        doMainMenu(useTor=True, circuitManager=connection_management.CircuitManager())
+        circuitManager = connection_management.CircuitManager()
+        # build circuits while the user is still in the main menu
+        circuitManager.startWarmUp()
+        doMainMenu(useTor=True, circuitManager=circuitManager,
+                usePlayerController=usePlayerController)
+        circuitManager.stopWarmUp()
     return indicator_classes.ReturnFromMenu
 
 
 
-def doMainMenu(useTor=False, circuitManager=None):
+def doMainMenu(useTor=False, circuitManager=None, usePlayerController=False):
+    streamResolver = stream_resolution.StreamResolver(useTor=useTor,
+            circuitManager=circuitManager)
+    downloadManager = download_management.DownloadManager(useTor=useTor,
+            circuitManager=circuitManager)
+    playerController = None
+    if usePlayerController:
+        playerController = player_controller.MpvController(useTor=useTor,
+                circuitManager=circuitManager)
     menuOptions =   [
         method_menu.MethodMenuDecision( 
             "Search for video",
@@ -306,7 +482,18 @@ def doMainMenu(useTor=False, circuitManager=None):
             "Browse subscriptions",
             doInteractiveBrowseSubscriptions,
             useTor = useTor,
-            circuitManager = circuitManager
+            circuitManager = circuitManager,
+            streamResolver = streamResolver,
+            playerController = playerController,
+            downloadManager = downloadManager
+        ), method_menu.MethodMenuDecision( 
+            "Download unseen videos",
+            doDownloadUnseenVideos,
+            downloadManager
+        ), method_menu.MethodMenuDecision( 
+            "Show downloads",
+            doShowDownloads,
+            downloadManager
         ), method_menu.MethodMenuDecision( 
             "Subscribe to new channel",
             doInteractiveChannelSubscribe,
@@ -321,6 +508,10 @@ def doMainMenu(useTor=False, circuitManager=None):
         )
     ]
     method_menu.doMethodMenu("What do you want to do?", menuOptions)
+    streamResolver.shutdown()
+    downloadManager.shutdown()
+    if playerController is not None:
+        playerController.quit()
     return indicator_classes.ReturnFromMenu
 
 ################
@@ -331,6 +522,27 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="A YouTube-client for managing subscriptions and watching videos anonymously over Tor without a Google account.")
     parser.add_argument('--use-thumbnails', action='store_true')
+    parser.add_argument('--import-subscriptions', metavar='FILE',
+            help="import subscriptions from an OPML or CSV file and exit")
+    parser.add_argument('--export-subscriptions', metavar='FILE',
+            help="export subscriptions to an OPML or CSV file and exit")
+    parser.add_argument('--refresh-imported', action='store_true',
+            help="refresh imported subscriptions in a single batch after importing")
+    parser.add_argument('--use-tor', action='store_true',
+            help="use tor when importing subscriptions or running the server")
+    parser.add_argument('--server', action='store_true',
+            help="run a local API server sharing one database and refresh pipeline " + \
+                    "between clients (use together with --use-tor to use tor)")
+    parser.add_argument('--websub-callback-url', metavar='URL',
+            help="with --server, have new uploads pushed by the WebSub hub to this " + \
+                    "publicly reachable URL, instead of polling every feed")
+    parser.add_argument('--websub-hub-url', metavar='URL',
+            default=constants.WEBSUB_HUB_URL, help="WebSub hub to subscribe at")
+    parser.add_argument('--player-controller', action='store_true',
+            help="keep a single mpv instance running and queue videos in it")
+    parser.add_argument('--profile', action='store_true',
+            help="profile every flow, writing the profiles to " + \
+                    "~/.youtube_rss/profiles (summarize them with 'profiles')")
     args = parser.parse_args()
 
     if args.use_thumbnails:
@@ -338,10 +550,39 @@ if __name__ == '__main__':
 
     if not os.path.isdir(constants.YOUTUBE_RSS_DIR):
         os.mkdir(constants.YOUTUBE_RSS_DIR)
+    if args.profile:
+        profiling.useProfiler(profiling.FlowProfiler())
     if not os.path.isfile(constants.DATABASE_PATH):
         database = database_management.initiateYouTubeRssDatabase()
         presentation.doWaitScreen('', database_management.outputDatabaseToFile, database, constants.DATABASE_PATH)
     else:
-        database = presentation.doWaitScreen('', database_management.parseDatabaseFile, constants.DATABASE_PATH)
-
-    doStartupMenu()
+        database = presentation.doWaitScreen('', database_management.loadDatabase)
+
+    client = api_client.ApiClient()
+    if not args.server and client.isAvailable():
+        database_management.useApiClient(client)
+    if args.server:
+        if client.isAvailable():
+            print("an API server is already running")
+        else:
+            circuitManager = connection_management.CircuitManager() if args.use_tor \
+                    else None
+            api_server.runApiServer(useTor=args.use_tor, circuitManager=circuitManager,
+                    webSubCallbackUrl=args.websub_callback_url,
+                    webSubHubUrl=args.websub_hub_url)
+    elif args.import_subscriptions or args.export_subscriptions:
+        if args.import_subscriptions:
+            circuitManager = connection_management.CircuitManager() if args.use_tor \
+                    else None
+            addedChannelIds, unresolved = import_export.importSubscriptionsFromFile(
+                    args.import_subscriptions, refresh=args.refresh_imported,
+                    useTor=args.use_tor, circuitManager=circuitManager)
+            print(f"imported {len(addedChannelIds)} channels")
+            for reference in unresolved:
+                print(f"could not resolve: {reference}")
+        if args.export_subscriptions:
+            import_export.exportSubscriptionsToFile(
+                    database_management.loadDatabase(),
+                    args.export_subscriptions)
+    else:
+        doStartupMenu(usePlayerController=args.player_controller)